@@ -1,4 +1,8 @@
-import os, sys, re, subprocess, tempfile, shutil, httplib, StringIO
+import os, sys, re, subprocess, tempfile, shutil, httplib, StringIO, threading, Queue, time, collections, math, contextlib, json, pipes, hashlib, fnmatch, sqlite3
+from appdeploy.cache import DirectoryCache, cacheKey
+from appdeploy.spool import NotificationSpool, SpoolWorker
+from appdeploy.state import StateStore
+from appdeploy.minify import MinifyCache, minifyTree
 
 def version_compare(v1, v2):
     vv1 = v1.replace('ebz_', '')
@@ -8,6 +12,90 @@ def version_compare(v1, v2):
     except Exception, e:
         raise Exception("Could not compare versions %s and %s: %s" % (v1, v2, repr(e)))
 
+def versionKey(v):
+    """Sort key ordering versions like version_compare(), computed once per
+    version instead of once per comparison.  Versions that are not made of
+    numbers sort before all others."""
+    try:
+        parts = [int(x) for x in v.replace('ebz_', '').split('.')]
+    except ValueError:
+        return (0, v)
+    # 1.0 and 1 are the same version
+    while parts and parts[-1] == 0:
+        parts.pop()
+    return (1, tuple(parts))
+
+class TagIndex(object):
+    """Tags of a repository sorted by decreasing version, cached on disk and
+    rebuilt only when the tag refs of the repository change"""
+
+    def __init__(self, cacheFile):
+        self.cacheFile = cacheFile
+        self.signature = None
+        self.tags = []
+
+    @staticmethod
+    def getRefsSignature(gitdir):
+        """Digest of the packed and loose tag refs of a repository, cheap to
+        compute without running git"""
+        if os.path.isdir(os.path.join(gitdir, ".git")):
+            gitdir = os.path.join(gitdir, ".git")
+        digest = hashlib.sha1()
+        packed = os.path.join(gitdir, "packed-refs")
+        if os.path.exists(packed):
+            with open(packed) as f:
+                digest.update(f.read())
+        tagsdir = os.path.join(gitdir, "refs", "tags")
+        for (dirpath, dirnames, filenames) in os.walk(tagsdir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                with open(path) as f:
+                    digest.update("%s %s" % (path[len(tagsdir):], f.read()))
+        return digest.hexdigest()
+
+    def load(self):
+        try:
+            with open(self.cacheFile) as f:
+                data = json.load(f)
+            self.signature = data['signature']
+            self.tags = data['tags']
+        except (IOError, ValueError, KeyError):
+            self.signature = None
+            self.tags = []
+
+    def save(self):
+        if not(os.path.isdir(os.path.dirname(self.cacheFile))):
+            os.makedirs(os.path.dirname(self.cacheFile))
+        tmp = "%s.%s.tmp" % (self.cacheFile, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({'signature': self.signature, 'tags': self.tags}, f)
+        os.rename(tmp, self.cacheFile)
+
+    def update(self, gitdir, listTags):
+        """Rebuild the index if the tag refs changed since it was saved
+
+        @param listTags function returning the list of tag names of gitdir
+        @return True if the index was rebuilt
+        """
+        signature = self.getRefsSignature(gitdir)
+        self.load()
+        if signature == self.signature:
+            return False
+        self.tags = sorted(listTags(), key=versionKey, reverse=True)
+        self.signature = signature
+        try:
+            self.save()
+        except (IOError, OSError), e:
+            print >> sys.stderr, "WARNING: could not save tag index %s: %s" % (self.cacheFile, e)
+        return True
+
+    def match(self, pattern="*"):
+        """@return tags matching the shell pattern, by decreasing version"""
+        if pattern == "*":
+            return list(self.tags)
+        return [tag for tag in self.tags if fnmatch.fnmatchcase(tag, pattern)]
+
 class DeploymentFailed(Exception):
     def __init__(self, message, originalException=None):
         Exception.__init__(self, message)
@@ -25,6 +113,480 @@ class UnknownRevision(Exception):
 class ExecuteFailed(DeploymentFailed):
     pass
 
+class TaskCancelled(Exception):
+    pass
+
+class TaskTimeout(Exception):
+    pass
+
+class HostNotReady(DeploymentFailed):
+    pass
+
+class TaskResult(object):
+    """Outcome of calling a function on a single item (usually a host) within
+    runConcurrently()"""
+    def __init__(self, item):
+        self.item = item
+        self.value = None
+        self.error = None
+        self.excInfo = None
+        self.duration = None
+        self.done = False
+
+    def succeeded(self):
+        return self.done and self.error is None
+
+def runConcurrently(fun, items, parallel=1, failFast=True, timeout=None):
+    """Call fun(item) for each item, with at most `parallel` calls in flight.
+
+    When failFast is set, no new call is started once a call raised an
+    exception: the remaining items are reported with a TaskCancelled error.
+    When timeout is set, calls that did not complete within that many seconds
+    are reported with a TaskTimeout error; their threads are left running in
+    the background and their outcome is discarded.  Without a timeout and with
+    parallel=1, everything runs in the calling thread, in order.
+
+    KeyboardInterrupt and SystemExit are not reported per item: no new call
+    is started, whatever failFast, and the exception is raised once the calls
+    in flight are done.
+
+    @return list of TaskResult in the order of items
+    """
+    results = [TaskResult(item) for item in items]
+    pending = Queue.Queue()
+    for result in results:
+        pending.put(result)
+    state = {'failed': False, 'expired': False, 'interrupted': None}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                result = pending.get_nowait()
+            except Queue.Empty:
+                return
+            if state['expired'] or state['interrupted'] is not None:
+                return
+            if failFast and state['failed']:
+                result.error = TaskCancelled("Not run because of a previous failure")
+                continue
+            start = time.time()
+            value = error = excInfo = None
+            try:
+                value = fun(result.item)
+            except (KeyboardInterrupt, SystemExit):
+                state['interrupted'] = sys.exc_info()
+                return
+            except BaseException, e:
+                error = e
+                excInfo = sys.exc_info()
+            with lock:
+                if state['expired']:
+                    return
+                result.value = value
+                result.error = error
+                result.excInfo = excInfo
+                result.duration = time.time() - start
+                result.done = True
+                if error is not None:
+                    state['failed'] = True
+
+    if timeout is None and (parallel <= 1 or len(results) <= 1):
+        worker()
+        if state['interrupted'] is not None:
+            raise state['interrupted'][0], state['interrupted'][1], state['interrupted'][2]
+        return results
+
+    threads = []
+    for i in range(max(1, min(parallel, len(results)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+    try:
+        for t in threads:
+            # Join with a timeout so that the main thread still receives
+            # KeyboardInterrupt
+            while t.isAlive():
+                if timeout is not None and time.time() >= deadline:
+                    break
+                t.join(0.1)
+    except (KeyboardInterrupt, SystemExit):
+        # Workers start no new call
+        state['interrupted'] = sys.exc_info()
+        raise
+
+    if state['interrupted'] is not None:
+        raise state['interrupted'][0], state['interrupted'][1], state['interrupted'][2]
+
+    with lock:
+        state['expired'] = True
+        for result in results:
+            if not(result.done) and result.error is None:
+                result.error = TaskTimeout("Did not complete within %s seconds" % timeout)
+
+    return results
+
+class BackgroundTask(object):
+    """Call fun() in a daemon thread, its outcome is collected by wait()"""
+    def __init__(self, fun):
+        self.fun = fun
+        self.started = time.time()
+        self.result = TaskResult(fun)
+        self.thread = threading.Thread(target=self.execute)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def execute(self):
+        try:
+            self.result.value = self.fun()
+        except BaseException, e:
+            self.result.error = e
+            self.result.excInfo = sys.exc_info()
+        self.result.duration = time.time() - self.started
+        self.result.done = True
+
+    def age(self):
+        return time.time() - self.started
+
+    def wait(self, timeout=None):
+        """Wait for fun() to complete
+
+        @param timeout raise TaskTimeout if fun() did not complete within that
+                       many seconds, leaving it running in the background
+        @return the value returned by fun(), or raise its exception
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        # Join with a timeout so that the main thread still receives
+        # KeyboardInterrupt
+        while self.thread.isAlive():
+            if timeout is not None and time.time() >= deadline:
+                raise TaskTimeout("Did not complete within %s seconds" % timeout)
+            self.thread.join(0.1)
+        if self.result.error is not None:
+            raise self.result.excInfo[0], self.result.excInfo[1], self.result.excInfo[2]
+        return self.result.value
+
+class RevisionResolver(object):
+    """Resolve dynamic revisions given as (function, arguments), eg the
+    revision deployed in another environment.
+
+    Lookups run in the background with a timeout.  Concurrent lookups of the
+    same function and arguments share a single call, and its result is
+    cached for ttl seconds, so that profiles reading their revision from the
+    same source issue one lookup.  Failures are not cached, the next lookup
+    tries again."""
+
+    def __init__(self, ttl=60, timeout=30):
+        self.ttl = ttl
+        self.timeout = timeout
+        # key -> (time, revision)
+        self.cache = {}
+        # key -> BackgroundTask of the lookup in progress
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, fun, args, timeout=None):
+        """@return the revision returned by fun(*args)
+        @raise UnknownRevision if the lookup failed or timed out
+        """
+        key = (fun, tuple(args))
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable arguments, do not share the lookup
+            key = None
+
+        def lookup():
+            try:
+                revision = fun(*args)
+                if key is not None:
+                    with self.lock:
+                        self.cache[key] = (time.time(), revision)
+                return revision
+            finally:
+                with self.lock:
+                    if self.pending.get(key) is task:
+                        del self.pending[key]
+
+        with self.lock:
+            if key in self.cache and time.time() - self.cache[key][0] <= self.ttl:
+                return self.cache[key][1]
+            task = self.pending.get(key)
+            if task is None:
+                task = BackgroundTask(lookup)
+                if key is not None:
+                    self.pending[key] = task
+
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return task.wait(timeout)
+        except TaskTimeout:
+            raise UnknownRevision("Revision lookup %s%r timed out after %s seconds" % (getattr(fun, '__name__', fun), tuple(args), timeout))
+
+    def invalidate(self):
+        with self.lock:
+            self.cache = {}
+
+# Shared by all profiles
+revisionResolver = RevisionResolver()
+
+class CommandResult(object):
+    """Outcome of runCommand(): exit status and the last lines of output"""
+    def __init__(self, args, tailLines):
+        self.args = args
+        self.status = None
+        self.timedOut = False
+        self.stdoutTail = collections.deque(maxlen=tailLines)
+        self.stderrTail = collections.deque(maxlen=tailLines)
+        self.stdoutLines = 0
+        self.stderrLines = 0
+
+    @staticmethod
+    def formatTail(tail, count):
+        omitted = count - len(tail)
+        if omitted > 0:
+            return "[... %s earlier lines omitted ...]\n%s" % (omitted, "".join(tail))
+        return "".join(tail)
+
+    def getStdoutTail(self):
+        return self.formatTail(self.stdoutTail, self.stdoutLines)
+
+    def getStderrTail(self):
+        return self.formatTail(self.stderrTail, self.stderrLines)
+
+def runCommand(args, cwd=None, onStdout=None, onStderr=None, timeout=None, tailLines=200, closeStdin=True):
+    """Run a command, draining its stdout and stderr concurrently so that it
+    can never block on a full pipe.  Each output line is passed to the
+    matching callback as soon as it is read, and only the last tailLines
+    lines of each stream are kept in memory.  The command is killed if it
+    runs for more than timeout seconds; processes it started are not, but
+    are no longer waited for even if they keep its output open.
+
+    @return CommandResult
+    """
+    result = CommandResult(args, tailLines)
+    stdin = None
+    if closeStdin:
+        stdin = subprocess.PIPE
+    p = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    if closeStdin:
+        p.stdin.close()
+
+    errors = []
+
+    def drain(pipe, tail, counter, callback):
+        for line in iter(pipe.readline, ""):
+            if result.timedOut:
+                # Only processes started by the killed command are left
+                break
+            tail.append(line)
+            setattr(result, counter, getattr(result, counter) + 1)
+            if callback is not None and not(errors):
+                try:
+                    callback(line)
+                except BaseException:
+                    # Keep draining, the error is raised once the command
+                    # is done
+                    errors.append(sys.exc_info())
+        pipe.close()
+
+    readers = [
+        threading.Thread(target=drain, args=(p.stdout, result.stdoutTail, "stdoutLines", onStdout)),
+        threading.Thread(target=drain, args=(p.stderr, result.stderrTail, "stderrLines", onStderr)),
+    ]
+    for t in readers:
+        t.daemon = True
+        t.start()
+
+    timer = None
+    if timeout is not None:
+        def kill():
+            result.timedOut = True
+            try:
+                p.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        for t in readers:
+            # Join with a timeout so that the main thread still receives
+            # KeyboardInterrupt
+            while t.isAlive() and not(result.timedOut and p.poll() is not None):
+                t.join(0.1)
+        result.status = p.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    return result
+
+class ChangeLog(object):
+    """Commits between two revisions, computed once per deployment.
+
+    The full log is capped to maxCommits commits and maxBytes bytes, the
+    summary used for notifications lists commits on a single line each."""
+    def __init__(self, oldRevision, newRevision):
+        self.oldRevision = oldRevision
+        self.newRevision = newRevision
+        # Total number of commits between both revisions
+        self.count = 0
+        # List of (abbreviated hash, author, subject), newest first
+        self.commits = []
+        self.text = ""
+        self.truncated = False
+
+    def getRange(self):
+        return "%s..%s" % (self.oldRevision, self.newRevision)
+
+    def isEmpty(self):
+        return self.count == 0
+
+    def getSummary(self, limit=50):
+        lines = ["%s %s (%s)\n" % (h, subject, author) for (h, author, subject) in self.commits[:limit]]
+        if self.count > len(lines):
+            lines.append("... and %s more commits\n" % (self.count - len(lines)))
+        return "".join(lines)
+
+class PhaseTimer(object):
+    """Record how long each phase of a deployment takes, per host for the
+    phases that run on each host"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, host=None):
+        start = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            with self.lock:
+                self.records.append({'phase': name, 'host': host, 'start': round(start - self.started, 3), 'duration': round(time.time() - start, 3), 'ok': ok})
+
+    def summary(self):
+        """@return list of (phase, count, total duration, max duration, slowest
+                   host) in the order phases started"""
+        phases = collections.OrderedDict()
+        with self.lock:
+            records = sorted(self.records, key=lambda r: r['start'])
+        for r in records:
+            (count, total, longest, slowest) = phases.get(r['phase'], (0, 0, 0, None))
+            if r['duration'] >= longest:
+                (longest, slowest) = (r['duration'], r['host'])
+            phases[r['phase']] = (count + 1, total + r['duration'], longest, slowest)
+        return [(name,) + values for (name, values) in phases.items()]
+
+    def total(self):
+        return time.time() - self.started
+
+    def asdict(self):
+        with self.lock:
+            records = sorted(self.records, key=lambda r: r['start'])
+        return {'total': round(self.total(), 3), 'phases': records}
+
+    def formatTable(self):
+        lines = ["%-20s %5s %10s %10s  %s" % ("Phase", "Count", "Total (s)", "Max (s)", "Slowest host")]
+        for (name, count, total, longest, slowest) in self.summary():
+            lines.append("%-20s %5s %10.2f %10.2f  %s" % (name, count, total, longest, slowest or ""))
+        lines.append("%-20s %5s %10.2f" % ("Total", "", self.total()))
+        return "\n".join(lines)
+
+    def formatSummaryLine(self):
+        return " ".join(["%s=%.2fs" % (name, total) for (name, count, total, longest, slowest) in self.summary()] + ["total=%.2fs" % self.total()])
+
+class SSHConnectionManager(object):
+    """Open a single master SSH connection per host and user (OpenSSH
+    ControlMaster), and let every ssh, rsync and unison invocation of the
+    deployment reuse it instead of performing a new handshake."""
+
+    def __init__(self, enabled=True, persist=300):
+        self.enabled = enabled
+        # Safety net: masters exit by themselves if close() is never called
+        self.persist = persist
+        self.controlDir = None
+        # (user, host) -> True if the master is up, False if it failed
+        self.masters = {}
+        self.hostLocks = {}
+        self.lock = threading.Lock()
+
+    def controlPath(self):
+        # %C is a hash of the connection parameters, which keeps the socket
+        # path short enough for the Unix socket length limit
+        return "%s/%%C" % self.controlDir
+
+    def open(self, user, host):
+        """Open the master connection to the host if not done yet.  A failure
+        is remembered, commands then connect directly.
+
+        @return True if a master connection is available
+        """
+        with self.lock:
+            if self.controlDir is None:
+                self.controlDir = tempfile.mkdtemp(prefix="appdeploy-ssh-", dir="/tmp")
+            hostLock = self.hostLocks.setdefault((user, host), threading.Lock())
+
+        with hostLock:
+            if (user, host) not in self.masters:
+                args = ["ssh", "-M", "-N", "-f", "-o", "ControlPath=%s" % self.controlPath(), "-o", "ControlPersist=%s" % self.persist]
+                if user:
+                    args += ["-l", user]
+                args.append(host)
+                # The master lives in the background: make sure it does not
+                # hold the pipes of any command
+                devnull = open(os.devnull, "r+")
+                try:
+                    self.masters[(user, host)] = subprocess.call(args, stdin=devnull, stdout=devnull, stderr=devnull) == 0
+                except OSError:
+                    self.masters[(user, host)] = False
+                finally:
+                    devnull.close()
+            return self.masters[(user, host)]
+
+    def options(self, user, host):
+        """@return list of ssh options to reuse the master connection to the
+                   host, opening it if needed"""
+        if not(self.enabled) or not(self.open(user, host)):
+            return []
+        return ["-o", "ControlPath=%s" % self.controlPath(), "-o", "ControlMaster=no"]
+
+    def close(self):
+        """Tear down all master connections"""
+        with self.lock:
+            if self.controlDir is None:
+                return
+            devnull = open(os.devnull, "r+")
+            try:
+                for ((user, host), up) in self.masters.items():
+                    if not(up):
+                        continue
+                    args = ["ssh", "-O", "exit", "-o", "ControlPath=%s" % self.controlPath()]
+                    if user:
+                        args += ["-l", user]
+                    args.append(host)
+                    subprocess.call(args, stdin=devnull, stdout=devnull, stderr=devnull)
+            finally:
+                devnull.close()
+            shutil.rmtree(self.controlDir, True)
+            self.controlDir = None
+            self.masters = {}
+            self.hostLocks = {}
+
 class BaseDeploymentProfile(object):
     def __init__(self, **kw):
         # Initialize optional fields
@@ -32,33 +594,92 @@ class BaseDeploymentProfile(object):
         self.remoteUser = None
         self.remoteDir = None
         self.revision = None
+        # Seconds to wait for a dynamic revision, see getRevision()
+        self.revisionTimeout = None
+        self.revisionError = None
         self.dbVersionCheck = None
         self.recipient = None
         self.useRsync = False
         self.selectTag = False
+        # Tags offered when selectTag is set are named <branch>.*
+        self.branch = None
         self.name = None
         self.hosts = []
         self.deploymentEngine = None
+        # Rollout plan: optional canary host deployed alone first, then
+        # waves of hosts given as a count or a percentage such as "25%".  The
+        # last wave size is repeated until all hosts are deployed.
+        self.canary = None
+        self.waves = None
+        # (port, uri) to fetch the deployed revision over HTTP after each
+        # wave, the rollout is aborted if a host does not serve the new
+        # revision within healthCheckTimeout seconds
+        self.healthCheck = None
+        self.healthCheckTimeout = 120
+        # Hosts restarted at the same time by the after-push hooks, as a
+        # count or a percentage of the hosts such as "10%".  A host counts as
+        # unavailable until its hook is done and it passed the health check.
+        self.maxUnavailable = 1
+        # Push each revision to remoteDir/releases/<revision>, hard-linking
+        # unchanged files against the previous release, then atomically
+        # point the remoteDir/current symlink to it.  Only keepReleases
+        # releases are kept on each host.  Requires rsync.
+        self.releaseLayout = False
+        self.keepReleases = 5
+        # Fan-out groups, as lists of hosts: the first host of each group, its
+        # seed, gets the push from this machine and relays it to the other
+        # hosts of the group, so that the tree crosses slow links once.  The
+        # seed connects to its peers with a forwarded SSH agent.  Peers get
+        # the tree of the seed, including what beforePushHost() did for it.
+        self.fanOut = None
+        # Minify the JavaScript and CSS files of the tree after beforePush(),
+        # unless --skip-minify is given.  Requires the rjsmin and rcssmin
+        # modules.  Files matching minifyExclude patterns, relative to the
+        # root of the tree, are left alone.
+        self.minifyAssets = False
+        self.minifyExclude = []
+        # Give each host its own tree, hard-linked against the shared workdir,
+        # so that beforePushHost() can customize it with writeHostFile()
+        # while other hosts are prepared and pushed concurrently.  Relayed
+        # fan-out peers get the tree of their seed without the files written
+        # for the seed, then their own files.  Requires rsync with fanOut.
+        self.hostOverlays = False
 
         for key in kw.keys():
             setattr(self, key, kw[key])
         self.applyConventions()
 
-    def getRevision(self):
+    def getRevision(self, resolver=None):
         """self.revision can be either a refspec or a tuple containing (function,
         arguments) to compute refspec dynamically, used eg to deploy production
         from a specific revision currently deployed in the staging environment.
-        The value is computed only for the first call to getRevision().  Can be
-        None if there was an error fetching the value."""
+        The value is computed by the resolver, revisionResolver by default,
+        until a call succeeds.  Can be None if there was an error fetching the
+        value, in which case isRevisionUnknown() is true and the next call
+        tries again."""
         if isinstance(self.revision, tuple):
             (fun, args) = self.revision
+            if resolver is None:
+                resolver = revisionResolver
             try:
-                self.revision = apply(fun, args)
+                self.revision = resolver.resolve(fun, args, self.revisionTimeout)
+                self.revisionError = None
             except UnknownRevision, e:
-                self.revision = None
+                self.revisionError = e
+                return None
 
         return self.revision
 
+    def isRevisionResolved(self):
+        """@return False while a dynamic revision was not computed
+                   successfully"""
+        return not(isinstance(self.revision, tuple))
+
+    def isRevisionUnknown(self):
+        """@return True if computing the dynamic revision failed, as opposed
+                   to not attempted yet"""
+        return not(self.isRevisionResolved()) and self.revisionError is not None
+
     def getDisplayRevision(self):
         c = self.getRevision()
         if c is None:
@@ -85,6 +706,74 @@ class DeploymentOptions(object):
         self.skippedHosts = []
         self.skipDbVersionCheck = False
         self.skipRestart = False
+        self.parallel = 1
+        self.failFast = True
+        self.probeTimeout = 15
+        self.cacheDir = "/var/tmp/appdeploy"
+        self.useMirror = True
+        # In megabytes
+        self.mirrorCacheSize = 10240
+        self.exportTree = False
+        # Fetch only the requested revision, without the file contents of
+        # older commits, instead of cloning the whole repository.  History is
+        # deepened until the deployed revision is reachable, and only to
+        # compute the changelog.  Not used when cloning from the mirror.
+        self.shallowClone = False
+        self.useArtifactCache = False
+        self.forceRebuild = False
+        # In megabytes
+        self.artifactCacheSize = 5120
+        self.sshMultiplexing = True
+        self.timingReport = None
+        # When not interactive, confirmations are answered by confirmPolicy:
+        #  "always" confirms any deployment,
+        #  "new-revision" refuses to deploy the revision already deployed,
+        #  "never" stops before pushing anything
+        self.interactive = True
+        self.confirmPolicy = "new-revision"
+        self.deltaPush = False
+        self.rollback = False
+        # Cap the changelog shown for review and written along the tree
+        self.changeLogMaxCommits = 500
+        self.changeLogMaxBytes = 1024 * 1024
+        # Notifications are spooled in cacheDir/notifications and sent in the
+        # background.  At the end of the deployment, wait at most that many
+        # seconds for them to be sent, leaving the rest to later deployments.
+        self.notifyTimeout = 10
+        # Overrides the maxUnavailable setting of the profile
+        self.maxUnavailable = None
+        # Probes and mirror updates started in the background while the
+        # operator browses the menus are redone by prepare() when older
+        self.prefetchMaxAge = 120
+        # Deployments and the revision of each host are recorded in this
+        # SQLite database, cacheDir/state.db by default
+        self.stateFile = None
+        # Take the revisions recorded less than stateMaxAge seconds ago for
+        # granted instead of probing the hosts.  Only safe when nobody
+        # deploys the same hosts from elsewhere.
+        self.trustState = False
+        self.stateMaxAge = 600
+        # Processes minifying assets, the number of CPUs by default
+        self.minifyProcesses = None
+        # In megabytes
+        self.minifyCacheSize = 512
+
+CONFIRM_POLICIES = ("always", "new-revision", "never")
+
+def getOperator():
+    return os.environ.get("LOGNAME") or os.environ.get("USER")
+
+def getStateStore(options):
+    """@return the StateStore configured by the options, or None if it can
+               not be opened"""
+    path = options.stateFile
+    if path is None:
+        path = os.path.join(options.cacheDir, "state.db")
+    try:
+        return StateStore(path)
+    except (sqlite3.Error, OSError), e:
+        print >> sys.stderr, "WARNING: Could not open deployment state %s: %s" % (path, e)
+        return None
 
 class BaseDeploymentEngine(object):
     def __init__(self, profile, options):
@@ -92,6 +781,32 @@ class BaseDeploymentEngine(object):
         self.success = 0
         self.cancelled = False
         self.options = options
+        self.outputLock = threading.Lock()
+        self.deployedHosts = None
+        self.mirror = None
+        self.connections = SSHConnectionManager(options.sshMultiplexing)
+        self.timer = PhaseTimer()
+        self.deltaFileList = None
+        self.tagIndex = None
+        self.changeLog = None
+        self.changeLogs = {}
+        self.notifier = None
+        # name -> BackgroundTask, see prefetch()
+        self.prefetched = {}
+        self.stateStore = None
+        self.trustedHosts = []
+        self.repo = None
+        self.gitdir = None
+        # Hosts whose new release is activated
+        self.activatedHosts = []
+        # host -> release it was rolled back to, see rollbackHost()
+        self.rolledBackReleases = {}
+        # Set when the workdir is a shallow clone, see fetchRevision()
+        self.shallow = False
+        self.shallowRefspec = None
+        self.fetchedRevision = None
+        # host -> paths written by writeHostFile(), relative to the tree
+        self.hostFiles = {}
 
     def prepare(self):
         if not(self.profile.hosts):
@@ -102,9 +817,113 @@ class BaseDeploymentEngine(object):
         # unique file name in fact.
         os.rmdir(self.workdir)
 
-        self.oldRevision = self.fetchCurrentDeployedRevision()
-        repo = self.pickRepo()
-        self.checkout(repo)
+        # Retry notifications left over by previous deployments while this one
+        # runs
+        spoolDir = self.getNotificationSpoolDir()
+        if self.options.doNotify and os.path.isdir(spoolDir) and [f for f in os.listdir(spoolDir) if f.endswith(".msg")]:
+            self.getNotifier()
+
+        with self.timer.phase("probe"):
+            self.deployedRevisions = self.collectPrefetched("probe", self.fetchCurrentDeployedRevision)
+        if self.trustedHosts:
+            print " Using the recorded revision of %s, not probed" % ", ".join(self.trustedHosts)
+        self.oldRevision = self.getOldRevision(self.deployedRevisions)
+        with self.timer.phase("pickRepo"):
+            self.repo = self.pickRepo()
+        if self.options.exportTree:
+            # Git metadata stays in the mirror, the tree is exported by reset()
+            self.gitdir = self.repo
+        elif self.hasCachedArtifact(self.repo):
+            # Git metadata stays in the repository, the tree is restored by
+            # run()
+            print " Found a cached artifact, not cloning %s" % self.repo
+        else:
+            self.clone()
+
+    def clone(self):
+        with self.timer.phase("checkout"):
+            self.checkout(self.repo)
+        self.gitdir = self.workdir
+        if self.shallow:
+            # Resolve the revision and list tags as in a full clone
+            with self.timer.phase("fetch"):
+                self.fetchShallow()
+
+    def hasCachedArtifact(self, repo):
+        """Look for the artifact of the requested revision with the local
+        repository, before cloning it.  The revision must be known: tags
+        selected later on are looked up after cloning.
+
+        @return True if found, in which case gitdir is set to the repository
+        """
+        if not(self.options.useArtifactCache) or self.options.forceRebuild or self.profile.selectTag:
+            return False
+        if not(os.path.isdir(repo)):
+            return False
+        revision = self.profile.getRevision()
+        if revision is None:
+            return False
+        self.gitdir = repo
+        try:
+            with self.timer.phase("findArtifact"):
+                if self.findArtifact(self.getArtifactKey(revision)) is not None:
+                    return True
+        except DeploymentFailed:
+            # Unknown revision, reported after cloning
+            pass
+        self.gitdir = None
+        return False
+
+    def prefetch(self):
+        """Start probing the hosts and updating the local mirror in the
+        background, eg while the operator still browses the menus, so that
+        prepare() only has to collect the outcome"""
+        if self.options.verbose:
+            # Commands would be echoed in the middle of the menus
+            return
+        self.prefetched["probe"] = BackgroundTask(self.fetchCurrentDeployedRevision)
+        url = self.getMirrorUrl()
+        if url is not None:
+            self.prefetched["mirror"] = BackgroundTask(lambda: self.updateMirror(url, quiet=True))
+
+    def cancelPrefetch(self):
+        """Discard the prefetched outcome, eg because the operator chose
+        another profile.  Tasks in progress still complete in the background:
+        the mirror they update stays useful, and the SSH master connections
+        opened by the probe are closed once it is done."""
+        probe = self.prefetched.get("probe")
+        self.prefetched = {}
+        if probe is None:
+            return
+
+        def cleanup():
+            try:
+                probe.wait()
+            except Exception:
+                pass
+            self.connections.close()
+        # Not a daemon thread: at worst, exiting waits for the probe timeout
+        # rather than leaving master connections behind.  The mirror update
+        # is not waited for, an interrupted clone is redone by the next
+        # deployment.
+        threading.Thread(target=cleanup).start()
+
+    def collectPrefetched(self, name, fun):
+        """@return the outcome of the prefetched task, or of fun() if the task
+                   was not started, failed or is too old"""
+        task = self.prefetched.pop(name, None)
+        if task is None:
+            return fun()
+        if task.age() > self.options.prefetchMaxAge:
+            print " Prefetched %s is %d seconds old, doing it again" % (name, task.age())
+            return fun()
+        try:
+            value = task.wait()
+        except Exception, e:
+            print " Prefetched %s failed, trying again: %s" % (name, e)
+            return fun()
+        print " Using %s prefetched in the background (took %.1fs)" % (name, task.result.duration)
+        return value
 
     def onSuccess(self):
         pass
@@ -115,19 +934,35 @@ class BaseDeploymentEngine(object):
             if revision is None:
                 raise DeploymentFailed("No revision provided on this deployment profile")
 
-            self.newRevision = self.reset(revision)
+            artifact = artifactKey = None
+            if self.options.useArtifactCache:
+                artifactKey = self.getArtifactKey(revision)
+                if not(self.options.forceRebuild):
+                    artifact = self.findArtifact(artifactKey)
+
+            if artifact is None:
+                if self.gitdir is None or (self.gitdir == self.repo and not(self.options.exportTree)):
+                    # The artifact found by prepare() is gone
+                    self.clone()
+                with self.timer.phase("reset"):
+                    self.newRevision = self.reset(revision)
+            else:
+                with self.timer.phase("restoreArtifact"):
+                    self.newRevision = self.restoreArtifact(artifact)
 
             if self.oldRevision is not None:
                 # NOTE: Old revision can be missing if it's eg the first deployment
                 print "Revision %s currently deployed" % self.oldRevision
                 if self.options.doWriteChangeLog:
                     try:
-                        self.writeChangeLog()
+                        with self.timer.phase("changelog"):
+                            self.writeChangeLog()
                     except ExecuteFailed:
                         # git log may fail to find the deployed revision
                         pass
 
-            self.requestConfirmation()
+            with self.timer.phase("confirmation"):
+                self.requestConfirmation()
 
             print " Deploying revision %s" % self.newRevision
 
@@ -136,25 +971,79 @@ class BaseDeploymentEngine(object):
             revfile.write(self.newRevision)
             revfile.close()
 
-            self.beforePush()
+            if artifact is None:
+                with self.timer.phase("beforePush"):
+                    self.beforePush()
+                if self.profile.minifyAssets and self.options.doMinify:
+                    with self.timer.phase("minify"):
+                        self.minify()
+
+            if self.options.deltaPush:
+                # Before removing the Git internals, gitdir may be the workdir
+                with self.timer.phase("delta"):
+                    self.deltaFileList = self.writeDeltaFileList()
 
             # Remove the Git internals
-            shutil.rmtree("%s/.git" % self.workdir)
+            if os.path.exists("%s/.git" % self.workdir):
+                shutil.rmtree("%s/.git" % self.workdir)
+
+            if artifact is None and artifactKey is not None:
+                with self.timer.phase("storeArtifact"):
+                    self.storeArtifact(artifactKey)
 
             # Push to target environment
             self.pushToRemoteHosts()
 
             self.success = 1
             try:
-                self.onSuccess()
+                with self.timer.phase("onSuccess"):
+                    self.onSuccess()
             except Exception, e:
                 print >> sys.stderr, "WARNING: failed to run onSuccess hook: %s" % repr(e)
 
         finally:
+            self.connections.close()
+            with self.timer.phase("notifyFlush"):
+                self.closeNotifier()
+            if self.deltaFileList is not None and os.path.exists(self.deltaFileList):
+                os.unlink(self.deltaFileList)
             if os.path.exists(self.workdir):
                 shutil.rmtree("%s" % self.workdir)
+            if os.path.exists(self.getOverlayRoot()):
+                shutil.rmtree(self.getOverlayRoot())
+            self.recordDeployment()
+            self.reportTimings()
+
+    def reportTimings(self):
+        """Print the time spent in each phase and write the JSON timing
+        report if requested"""
+        print
+        print self.timer.formatTable()
+
+        if self.options.timingReport:
+            report = self.timer.asdict()
+            report.update({
+                'application': getattr(self.profile, 'appName', None),
+                'profile': self.profile.name,
+                'engine': self.__class__.__name__,
+                'oldRevision': getattr(self, 'oldRevision', None),
+                'newRevision': getattr(self, 'newRevision', None),
+                'success': bool(self.success),
+            })
+            try:
+                with open(self.options.timingReport, "w") as f:
+                    json.dump(report, f, indent=2)
+            except IOError, e:
+                print >> sys.stderr, "WARNING: could not write timing report %s: %s" % (self.options.timingReport, e)
 
     def confirm(self, message):
+        if not(self.options.interactive):
+            # Questions asked by custom engines can not be answered by the
+            # policy, unless it confirms everything
+            answer = self.options.confirmPolicy == "always"
+            print "%s%s (%s)" % (message, answer and "y" or "n", "confirm policy %s" % self.options.confirmPolicy)
+            return answer
+
         while 1:
             a = raw_input(message)
             if a == "y" or a == "Y":
@@ -162,9 +1051,31 @@ class BaseDeploymentEngine(object):
             elif a == 'n' or a == 'N':
                 return 0
 
+    def confirmByPolicy(self):
+        """Non-interactive counterpart of requestConfirmation()"""
+        policy = self.options.confirmPolicy
+        print
+        if self.oldRevision == self.newRevision:
+            print "Deploying the same revision %s again" % self.newRevision
+            confirmed = policy == "always"
+        else:
+            if self.oldRevision is not None:
+                print "Upgrading from revision %s to revision %s" % (self.oldRevision, self.newRevision)
+            else:
+                print "Deploying revision %s" % self.newRevision
+            confirmed = policy in ("always", "new-revision")
+
+        if not(confirmed):
+            print "Not confirmed by confirm policy %s" % policy
+            self.cancel()
+
     def requestConfirmation(self):
+        if not(self.options.interactive):
+            self.confirmByPolicy()
+            return
+
         if self.oldRevision is not None:
-            cl = self.getChangeLog()
+            cl = self.changeLog
         else:
             cl = None
 
@@ -173,19 +1084,12 @@ class BaseDeploymentEngine(object):
         if self.oldRevision == self.newRevision:
             if not(self.confirm("Confirm deploying the same revision %s again? [y/n] " % self.newRevision)):
                 self.cancel()
-        elif cl is not None and cl != "":
-            print "Need to confirm upgrading from revision %s to revision %s" % (self.oldRevision, self.newRevision)
+        elif cl is not None and not(cl.isEmpty()):
+            print "Need to confirm upgrading from revision %s to revision %s (%s commits)" % (self.oldRevision, self.newRevision, cl.count)
+            if cl.count > self.options.changeLogMaxCommits:
+                print "NOTE: Only the last %s commits will be shown" % self.options.changeLogMaxCommits
             raw_input("Press <Enter> to review the revision log ")
-            p = subprocess.Popen(["less"], stdin=subprocess.PIPE)
-            try:
-                p.stdin.write(cl)
-            except IOError, e:
-                if e.errno == 32:
-                    # Broken pipe, user quit less before we could write the
-                    # whole changelog
-                    pass
-            p.stdin.close()
-            p.wait()
+            self.showChangeLog()
 
             if not(self.confirm("Sign-off this revision log? [y/n] ")):
                 self.cancel()
@@ -211,69 +1115,334 @@ class BaseDeploymentEngine(object):
             yield host
 
     def notify(self):
-        args = ["/usr/sbin/sendmail", "-t", "-i"]
-        p = subprocess.Popen(args, stdin=subprocess.PIPE)
+        """Queue the deployment notification, it is sent in the background"""
+        try:
+            self.getNotifier().send(self.getNotification())
+        except (IOError, OSError), e:
+            print >> sys.stderr, "WARNING: Could not spool deployment notification: %s" % e
+
+    def getNotificationSpoolDir(self):
+        return os.path.join(self.options.cacheDir, "notifications")
+
+    def getNotifier(self):
+        if self.notifier is None:
+            spool = NotificationSpool(self.getNotificationSpoolDir(), ["/usr/sbin/sendmail", "-t", "-i"])
+            self.notifier = SpoolWorker(spool)
+        return self.notifier
+
+    def closeNotifier(self):
+        """Give pending notifications a chance to be sent before exiting"""
+        if self.notifier is None:
+            return
+        left = self.notifier.close(self.options.notifyTimeout)
+        self.notifier = None
+        if left:
+            print >> sys.stderr, "WARNING: %s notifications not sent yet, they will be retried by the next deployment" % left
+
+    def getNotification(self):
+        """@return the notification email, headers included"""
+        o = StringIO.StringIO()
 
         recipient = self.options.forceRecipient
 
         if not(recipient):
             recipient = self.profile.recipient
 
-        p.stdin.write("To: %s\n" % recipient)
-        p.stdin.write("Subject: Deployed %s %s to %s\n" % (self.profile.appName, self.profile.revision, self.profile.name))
+        o.write("To: %s\n" % recipient)
+        o.write("Subject: Deployed %s %s to %s\n" % (self.profile.appName, self.profile.revision, self.profile.name))
 
-        p.stdin.write("\n")
-        p.stdin.write("Affected hosts: %s\n\n" % ", ".join(self.getHosts()))
-        cl = self.getChangeLog()
+        o.write("\n")
+        hosts = self.deployedHosts
+        if hosts is None:
+            hosts = list(self.getHosts())
+        o.write("Affected hosts: %s\n\n" % ", ".join(hosts))
+        cl = self.changeLog
 
         if self.oldRevision == self.newRevision:
-            p.stdin.write("Deployed the same revision %s again" % self.newRevision)
-        elif cl and cl != "":
-            p.stdin.write("Upgrading from revision %s to revision %s\n\n" % (self.oldRevision, self.newRevision))
-            p.stdin.write(cl)
+            o.write("Deployed the same revision %s again" % self.newRevision)
+        elif cl is not None and not(cl.isEmpty()):
+            o.write("Upgrading from revision %s to revision %s (%s commits)\n\n" % (self.oldRevision, self.newRevision, cl.count))
+            o.write(cl.getSummary())
         else:
-            p.stdin.write("Upgrading to revision %s\n\n" % (self.newRevision))
-            p.stdin.write("  -- No changelog available --\n")
-
-        p.stdin.close()
-        sc = p.wait()
+            o.write("Upgrading to revision %s\n\n" % (self.newRevision))
+            o.write("  -- No changelog available --\n")
 
-        if sc != 0:
-            raise ExecuteFailed("Command '%s' returned status code %s\n\nCommand output:\n------------------------------------------------------------------------\n%s------------------------------------------------------------------------" % (" ".join(args), sc, p.stderr.read()))
+        return o.getvalue()
 
     def getChangeLog(self):
         """Get the changelog
 
         @return None if no changelog could be computed
         """
-        file = "%s/changelog.txt" % self.workdir
-
-        if os.path.exists(file):
-            f = open(file, "r")
-            c = f.read()
-            f.close()
-            return c
-        else:
+        if self.changeLog is None:
             return None
+        return self.changeLog.text
+
+    def computeChangeLog(self, oldRevision, newRevision):
+        """Compute the changelog between two revisions, at most once per pair
+
+        @return ChangeLog
+        """
+        key = (oldRevision, newRevision)
+        if key in self.changeLogs:
+            return self.changeLogs[key]
+
+        if self.shallow:
+            self.deepenUntilReachable(oldRevision)
+
+        cl = ChangeLog(oldRevision, newRevision)
+        maxCommits = self.options.changeLogMaxCommits
+
+        # The summary is parsed from the same log as the text: commits start
+        # with a "commit <hash>" line, message lines are indented
+        chunks = []
+        size = [0]
+        # [hash, author, subject] of each commit
+        commits = []
+        def onLine(line):
+            if line.startswith("commit "):
+                commits.append([line.split()[1], "", None])
+            elif commits and line.startswith("Author: "):
+                commits[-1][1] = line[len("Author: "):].split(" <")[0].strip()
+            elif commits and line.startswith("    ") and commits[-1][2] is None:
+                commits[-1][2] = line.strip()
+            if cl.truncated:
+                return
+            if size[0] + len(line) > self.options.changeLogMaxBytes:
+                # Later lines may fit, but the text must not skip any
+                cl.truncated = True
+                return
+            chunks.append(line)
+            size[0] += len(line)
+        self.bexecute(["git", "log", "--abbrev-commit", "--no-decorate", "-n", str(maxCommits), cl.getRange()], cwd=self.gitdir, onLine=onLine)
+        cl.commits = [(h, author, subject or "") for (h, author, subject) in commits]
+        cl.count = len(cl.commits)
+        if cl.count >= maxCommits:
+            # Only counted when the log was capped
+            cl.count = int(self.bexecute(["git", "rev-list", "--count", cl.getRange()], cwd=self.gitdir).strip() or 0)
+        if cl.count > maxCommits:
+            cl.truncated = True
+        if cl.truncated:
+            chunks.append("\n[... changelog truncated, %s commits in total ...]\n" % cl.count)
+        cl.text = "".join(chunks)
+
+        self.changeLogs[key] = cl
+        return cl
 
     def writeChangeLog(self):
-        c = self.bexecute(["git", "log", "%s..%s" % (self.oldRevision, self.newRevision)], cwd=self.workdir)
+        self.changeLog = self.computeChangeLog(self.oldRevision, self.newRevision)
         with open("%s/changelog.txt" % self.workdir, "w") as f:
-            f.write(c)
+            f.write(self.changeLog.text)
+
+    def showChangeLog(self):
+        """Page the capped log between the deployed and new revisions, as
+        computed by computeChangeLog()"""
+        less = subprocess.Popen(["less"], stdin=subprocess.PIPE)
+        # Ignores the broken pipe if the user quits before the end of the log
+        less.communicate(self.changeLog.text)
 
     def pickRepo(self):
         """Pick the most relevant Git repository, depending on the availability of the requested repository on the local filesystem.
 
+        Remote repositories are cloned through a local mirror kept in
+        options.cacheDir, unless options.useMirror is disabled.
+
         @return path or URL to git repository suitable for issuing <tt>git clone</tt>
         """
         repo = self.profile.repositoryPath
+        if self.options.exportTree and not(self.options.useMirror):
+            raise DeploymentFailed("Exporting the tree requires the local mirror, please do not disable it")
+        if self.getMirrorUrl() is not None:
+            self.mirror = self.collectPrefetched("mirror", lambda: self.updateMirror(repo))
+            return self.mirror
         if not(os.path.exists(repo)):
             print "NOTE: Using a remote repository, this may be slow.  Consider maintaining a local mirror for your project."
-            return repo
         return repo
 
+    def getMirrorUrl(self):
+        """@return URL of the repository to go through the local mirror for,
+                   or None"""
+        repo = self.profile.repositoryPath
+        if not(self.options.useMirror):
+            return None
+        # Local repositories are mirrored too when exporting, so that
+        # revisions resolve the same way as in a clone
+        if self.options.exportTree or not(os.path.exists(repo)):
+            return repo
+        return None
+
+    def getMirrorCache(self):
+        return DirectoryCache(os.path.join(self.options.cacheDir, "mirrors"), self.options.mirrorCacheSize * 1024 * 1024)
+
+    def updateMirror(self, url, quiet=False):
+        """Create or incrementally update the bare mirror of the given
+        repository, and evict the least recently used mirrors if the cache
+        grew too large.
+
+        Besides the mirrored refs, the mirror maps branches to
+        refs/remotes/origin/* so that revisions like origin/master resolve
+        the same way in the mirror as in a regular clone.
+
+        @param quiet do not print progress, eg while curses is running
+        @return path to the mirror
+        """
+        cache = self.getMirrorCache()
+        key = cacheKey(url, url)
+        path = cache.path(key)
+
+        if not(quiet):
+            print
+        with cache.lock(key):
+            if cache.exists(key):
+                if not(quiet):
+                    print "Updating local mirror of %s" % url
+                self.bvexecute(["git", "fetch", "--prune", "origin"], cwd=path)
+            else:
+                if not(quiet):
+                    print "Creating local mirror of %s in %s" % (url, path)
+                cache.remove(key)
+                tmp = "%s.tmp" % path
+                self.bvexecute(["git", "clone", "--mirror", url, tmp])
+                self.bvexecute(["git", "config", "--add", "remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*"], cwd=tmp)
+                self.bvexecute(["git", "fetch", "origin"], cwd=tmp)
+                os.rename(tmp, path)
+            cache.commit(key)
+
+        for evicted in cache.evict(keep=[key]):
+            if not(quiet):
+                print " Evicted unused mirror %s" % evicted
+
+        return path
+
+    def getDeltaExtraPaths(self):
+        """Override to list the paths, relative to the workdir, that
+        beforePush() generates or modifies: they are pushed along with the
+        files changed between the deployed and the new revision"""
+        return []
+
+    def getDeltaFallbackReason(self):
+        """@return why only pushing the changed files is not possible, or None"""
+        if not(self.profile.useRsync):
+            return "only supported with rsync"
+        if self.profile.releaseLayout:
+            return "release directories are hard-linked against the previous release instead"
+        if self.oldRevision is None:
+            return "deployed revision is unknown"
+        hosts = list(self.getHosts())
+        revisions = set([self.deployedRevisions.get(host) for host in hosts])
+        if None in revisions:
+            return "deployed revision is unknown on %s" % ", ".join([host for host in hosts if self.deployedRevisions.get(host) is None])
+        if len(revisions) > 1:
+            return "hosts have different revisions deployed"
+        return None
+
+    def writeDeltaFileList(self):
+        """Write the list of paths changed or deleted between the deployed and
+        the new revision, to be pushed instead of the whole tree
+
+        @return path to the NUL-separated file list, or None to push the
+                whole tree
+        """
+        reason = self.getDeltaFallbackReason()
+        if reason is None:
+            try:
+                diff = self.bexecute(["git", "diff", "--name-only", "--no-renames", "-z", self.oldRevision, self.newRevision], cwd=self.gitdir)
+            except ExecuteFailed:
+                reason = "could not compare revisions %s and %s" % (self.oldRevision, self.newRevision)
+        if reason is not None:
+            print " Pushing the whole tree: %s" % reason
+            return None
+
+        # Deleted paths are listed too, rsync deletes them on the remote host
+        # thanks to --delete-missing-args
+        paths = [path for path in diff.split("\0") if path]
+        paths += ["rev.txt"] + self.getDeltaExtraPaths()
+        if os.path.exists("%s/changelog.txt" % self.workdir):
+            paths.append("changelog.txt")
+
+        (fd, listFile) = tempfile.mkstemp(prefix="%s-delta" % self.__class__.__name__, dir="/var/tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write("\0".join(paths))
+        print " Pushing %s changed paths between revisions %s and %s" % (len(paths), self.oldRevision, self.newRevision)
+        return listFile
+
+    def deltaArgs(self, host):
+        """@return rsync arguments restricting the push to the changed paths"""
+        if self.deltaFileList is None:
+            return []
+        listFile = self.deltaFileList
+        if self.hostFiles.get(host):
+            # Along with the files written for the host
+            with open(self.deltaFileList) as f:
+                paths = [path for path in f.read().split("\0") if path]
+            listFile = self.writeHostFileList(host, paths + self.hostFiles[host])
+        return ["--files-from=%s" % listFile, "--from0", "--delete-missing-args"]
+
     def getSource(self, host):
-        return "%s/" % self.workdir
+        return "%s/" % self.getHostDir(host)
+
+    def getOverlayRoot(self):
+        # Next to the workdir, so that both are on the same file system
+        return "%s.hosts" % self.workdir
+
+    def getHostDir(self, host):
+        """@return the tree pushed to the host: its overlay with hostOverlays,
+                   the shared workdir otherwise"""
+        if not(self.profile.hostOverlays):
+            return self.workdir
+        return os.path.join(self.getOverlayRoot(), host)
+
+    def createOverlay(self, host):
+        """Create the tree of the host as hard links to the files of the
+        workdir, which costs neither copying nor disk space"""
+        overlay = self.getHostDir(host)
+        if not(os.path.isdir(self.getOverlayRoot())):
+            try:
+                os.makedirs(self.getOverlayRoot())
+            except OSError:
+                # Created meanwhile for another host
+                pass
+        if os.path.exists(overlay):
+            shutil.rmtree(overlay)
+        try:
+            self.bexecute(["cp", "-al", self.workdir, overlay])
+        except ExecuteFailed, e:
+            raise DeploymentFailed("Failed to create the tree of host %s" % host, e)
+
+    def removeOverlay(self, host):
+        if self.profile.hostOverlays and os.path.exists(self.getHostDir(host)):
+            shutil.rmtree(self.getHostDir(host))
+
+    def writeHostFile(self, host, path, content):
+        """Write a file of the tree pushed to the host, eg from
+        beforePushHost().  With hostOverlays, the file is replaced rather than
+        modified in place: the other hosts and the workdir keep their copy.
+        Files of the overlay must not be modified any other way.
+
+        @param path relative to the root of the tree
+        """
+        filename = os.path.join(self.getHostDir(host), path)
+        if not(os.path.isdir(os.path.dirname(filename))):
+            os.makedirs(os.path.dirname(filename))
+        if os.path.lexists(filename):
+            # Break the hard link
+            os.unlink(filename)
+        with open(filename, "w") as f:
+            f.write(content)
+        self.hostFiles.setdefault(host, []).append(path)
+
+    def writeHostFileList(self, host, paths):
+        """@return path to a NUL-separated list of paths for rsync --files-from"""
+        listFile = os.path.join(self.getOverlayRoot(), "%s.files" % host)
+        if not(os.path.isdir(self.getOverlayRoot())):
+            try:
+                os.makedirs(self.getOverlayRoot())
+            except OSError:
+                # Created meanwhile for another host
+                pass
+        with open(listFile, "w") as f:
+            f.write("\0".join(paths))
+        return listFile
 
     def getDestination(self, host):
         if not(self.profile.remoteUser):
@@ -281,53 +1450,547 @@ class BaseDeploymentEngine(object):
         if not(self.profile.remoteDir):
             raise DeploymentFailed("remoteDir is not set")
 
-        if self.useRsync:
+        if self.profile.releaseLayout:
+            if not(self.profile.useRsync):
+                raise DeploymentFailed("releaseLayout requires useRsync")
+            return "%s@%s:%s" % (self.profile.remoteUser, host, self.getRemoteReleaseDir(self.getReleaseName(host)))
+
+        if self.profile.useRsync:
             return "%s@%s:%s" % (self.profile.remoteUser, host, self.profile.remoteDir)
 
         return "ssh://%s@%s/%s" % (self.profile.remoteUser, host, self.profile.remoteDir)
 
-    def getSyncCommandLine(self, host):
+    def getRemoteRoot(self):
+        """@return the remote directory the application is served from"""
+        if self.profile.releaseLayout:
+            return "%s/current" % self.profile.remoteDir
+        return self.profile.remoteDir
+
+    def getRemoteReleaseDir(self, revision):
+        return "%s/releases/%s" % (self.profile.remoteDir, revision)
+
+    def isReleaseStaged(self, host):
+        """@return whether the new release is pushed to a staging directory
+                   of the host, because its release directory may be the
+                   one currently served"""
+        previous = self.deployedRevisions.get(host)
+        return previous is None or previous == self.newRevision
+
+    def getReleaseName(self, host):
+        """@return the name of the directory of releases/ the host gets the
+                   new release in"""
+        if self.isReleaseStaged(host):
+            return "%s.new" % self.newRevision
+        return self.newRevision
+
+    def releaseArgs(self, host):
+        """@return rsync arguments to create the release directory, sharing
+                   unchanged files with the release currently deployed"""
+        if not(self.profile.releaseLayout):
+            return []
+        args = ["--rsync-path=mkdir -p %s && rsync" % pipes.quote("%s/releases" % self.profile.remoteDir)]
+        previous = self.deployedRevisions.get(host)
+        if previous is not None:
+            # Relative to the destination directory
+            args.append("--link-dest=../%s" % previous)
+        return args
+
+    def activateRelease(self, host, revision):
+        """Atomically point the current symlink of the host to the given
+        release"""
+        root = pipes.quote(self.profile.remoteDir)
+        release = pipes.quote(revision)
+        self.bvexecute(self.sshCommandLine(host) + ["cd %s && test -d releases/%s && touch releases/%s && ln -sfn releases/%s current.tmp && mv -T current.tmp current" % (root, release, release, release)])
+
+    def activateStagedRelease(self, host, revision):
+        """Move the release staged in releases/<revision>.new to
+        releases/<revision> and activate it.  If releases/<revision> exists,
+        it may be served: current is first pointed to the staged release,
+        then releases/<revision> is replaced by hard links to it."""
+        root = pipes.quote(self.profile.remoteDir)
+        release = pipes.quote(revision)
+        staged = pipes.quote("%s.new" % revision)
+        self.bvexecute(self.sshCommandLine(host) + ["cd %(root)s && test -d releases/%(staged)s && if test -e releases/%(release)s; then ln -sfn releases/%(staged)s current.tmp && mv -T current.tmp current && rm -rf releases/%(release)s && cp -al releases/%(staged)s releases/%(release)s; else mv releases/%(staged)s releases/%(release)s; fi && touch releases/%(release)s && ln -sfn releases/%(release)s current.tmp && mv -T current.tmp current && rm -rf releases/%(staged)s" % {'root': root, 'release': release, 'staged': staged}])
+
+    def pruneReleases(self, host):
+        """Remove the oldest releases of the host, keeping keepReleases of them
+        including the current one"""
+        keep = max(1, self.profile.keepReleases)
+        self.bvexecute(self.sshCommandLine(host) + ["cd %s/releases && current=$(basename \"$(readlink ../current)\") && ls -1t | grep -vx \"$current\" | tail -n +%s | xargs -r rm -rf --" % (pipes.quote(self.profile.remoteDir), keep)])
+
+    def activateReleaseOnHost(self, host):
+        with self.timer.phase("activate", host):
+            try:
+                if self.isReleaseStaged(host):
+                    self.activateStagedRelease(host, self.newRevision)
+                else:
+                    self.activateRelease(host, self.newRevision)
+            except ExecuteFailed, e:
+                raise DeploymentFailed("Failed to activate release %s on remote host %s" % (self.newRevision, host), e)
+            self.activatedHosts.append(host)
+            try:
+                self.pruneReleases(host)
+            except ExecuteFailed, e:
+                print >> sys.stderr, "WARNING: failed to remove old releases on %s: %s" % (host, e)
+
+    def getCurrentRelease(self, host):
+        """@return the name of the release the host currently serves"""
+        return os.path.basename(self.bexecute(self.sshCommandLine(host) + ["readlink %s/current" % pipes.quote(self.profile.remoteDir)]).strip())
+
+    def demoteRelease(self, host, release):
+        """Make a release the least recently activated one, so that it is
+        neither rolled back to nor kept over the other releases"""
+        self.bvexecute(self.sshCommandLine(host) + ["touch -d @0 %s" % pipes.quote(self.getRemoteReleaseDir(release))])
+
+    def getPreviousRelease(self, host):
+        """@return the most recently activated release of the host besides
+                   the current one and staged releases"""
+        output = self.bexecute(self.sshCommandLine(host) + ["cd %s/releases && current=$(basename \"$(readlink ../current)\") && ls -1t | grep -vx \"$current\" | grep -v '\\.new$' | head -n 1" % pipes.quote(self.profile.remoteDir)])
+        release = output.strip()
+        if not(release):
+            raise DeploymentFailed("No previous release to roll back to on remote host %s" % host)
+        return release
+
+    def rollbackHost(self, host):
+        try:
+            current = self.getCurrentRelease(host)
+            release = self.getPreviousRelease(host)
+            self.say(" Rolling back %s to release %s" % (host, release))
+            self.activateRelease(host, release)
+            self.rolledBackReleases[host] = release
+            if current:
+                # The next rollback goes further back
+                self.demoteRelease(host, current)
+        except ExecuteFailed, e:
+            raise DeploymentFailed("Failed to roll back remote host %s" % host, e)
+
+    def rollback(self):
+        """Point the current symlink of every host back to the release that
+        was active before, and run the after-push hooks"""
+        try:
+            if not(self.profile.releaseLayout):
+                raise DeploymentFailed("Rolling back requires releaseLayout on the deployment profile")
+
+            hosts = list(self.getHosts())
+            print
+            if self.options.interactive:
+                if not(self.confirm("Confirm rolling back %s on %s to the previous release? [y/n] " % (self.profile.name, ", ".join(hosts)))):
+                    self.cancel()
+            elif self.options.confirmPolicy == "never":
+                print "Not confirmed by confirm policy never"
+                self.cancel()
+
+            results = self.runOnHosts(self.rollbackHost, hosts)
+            self.deployedHosts = [r.item for r in results if r.succeeded()]
+            self.checkHostResults("Rollback", results)
+
+            results = self.restartHosts(self.deployedHosts)
+            self.checkHostResults("After-push hook", results)
+            self.success = 1
+        finally:
+            self.connections.close()
+            if self.deployedHosts:
+                # The previous releases were not recorded
+                self.updateState(lambda store: store.forgetHosts(self.getRemoteRoot(), self.deployedHosts))
+
+    def getSyncCommandLine(self, host, seed=None):
+        """@param seed if set, build the command line run on this seed host to
+                    relay its tree to the host"""
         if self.profile.useRsync:
             args = ['rsync']
-            args += self.rsyncArgs(host)
+            if seed is None:
+                args += self.rsyncArgs(host)
+            else:
+                args += self.rsyncArgs(host, seed=seed)
             args += self.rsyncOptions(host)
         else:
             args = ['unison']
-            args += self.unisonArgs(host)
+            if seed is None:
+                args += self.unisonArgs(host)
+            else:
+                args += self.unisonArgs(host, seed=seed)
             args += self.unisonOptions(host)
 
         return args
 
+    def runOnHosts(self, fun, hosts):
+        """Run fun(host) on the given hosts honoring the --parallel and
+        --continue-on-error options
+
+        @return list of TaskResult, one per host
+        """
+        return runConcurrently(fun, list(hosts), self.options.parallel, self.options.failFast)
+
+    def say(self, message):
+        """Print a message, without interleaving it with the output of
+        concurrent host operations"""
+        with self.outputLock:
+            print message
+
+    def printHostOutput(self, host, output):
+        with self.outputLock:
+            for line in output.splitlines():
+                print " [%s] %s" % (host, line)
+
+    def checkHostResults(self, action, results):
+        """Print which hosts succeeded and which failed, and raise
+        DeploymentFailed if any host failed"""
+        succeeded = [r.item for r in results if r.succeeded()]
+        failed = [r for r in results if r.error is not None and not(isinstance(r.error, TaskCancelled))]
+        cancelled = [r.item for r in results if isinstance(r.error, TaskCancelled)]
+
+        if len(results) > 1 and (failed or self.options.parallel > 1):
+            print
+            print "%s summary:" % action
+            if succeeded:
+                print "  succeeded: %s" % ", ".join(succeeded)
+            if failed:
+                print "  failed:    %s" % ", ".join([r.item for r in failed])
+            if cancelled:
+                print "  cancelled: %s" % ", ".join(cancelled)
+
+        if len(failed) == 1:
+            raise failed[0].excInfo[0], failed[0].excInfo[1], failed[0].excInfo[2]
+        elif failed:
+            raise DeploymentFailed("%s failed on %s hosts:\n\n%s" % (action, len(failed), "\n\n".join(["%s: %s" % (r.item, r.error) for r in failed])))
+
+    def prepareHost(self, host):
+        self.hostFiles.pop(host, None)
+        if self.profile.hostOverlays:
+            with self.timer.phase("overlay", host):
+                self.createOverlay(host)
+        # Give a last chance to customize the tree of the host
+        with self.timer.phase("beforePushHost", host):
+            self.beforePushHost(host)
+
+    def pushToHost(self, host):
+        try:
+            self.prepareHost(host)
+            self.syncToHost(host)
+        finally:
+            self.removeOverlay(host)
+
+    def syncToHost(self, host):
+        self.say(" Pushing to %s" % host)
+
+        args = []
+        try:
+            args = self.getSyncCommandLine(host)
+            args += self.deltaArgs(host)
+            args += self.releaseArgs(host)
+            args.append(self.getSource(host))
+            args.append(self.getDestination(host))
+            with self.timer.phase("push", host):
+                if self.options.parallel > 1:
+                    # Keep the output of each host together
+                    output = self.bexecute(args)
+                    if self.options.verbose:
+                        self.printHostOutput(host, output)
+                else:
+                    self.bvexecute(args)
+        except OSError, e:
+            if e.errno == 2:
+                raise DeploymentFailed("useRsync=%s but %s is not installed" % (self.profile.useRsync, args[0]))
+            raise
+        except ExecuteFailed, e:
+            raise DeploymentFailed("Failed to push %s to remote host %s" % (self.profile.appName, host), e)
+
+    def relayToHost(self, seed, host):
+        """Push to the host from the seed host of its fan-out group, which
+        already got the new tree"""
+        try:
+            self.prepareHost(host)
+            self.relayTreeToHost(seed, host)
+            paths = list(self.hostFiles.get(host, []))
+            if self.profile.hostOverlays:
+                # Not relayed, the peer gets the files of the workdir
+                paths += [path for path in self.hostFiles.get(seed, []) if path not in paths]
+            if paths and self.profile.useRsync:
+                self.pushHostFiles(host, paths)
+        finally:
+            self.removeOverlay(host)
+
+    def relayTreeToHost(self, seed, host):
+        self.say(" Relaying to %s from %s" % (host, seed))
+
+        args = self.getSyncCommandLine(host, seed)
+        args += self.releaseArgs(host)
+        if self.profile.hostOverlays:
+            # Neither copied nor deleted on the peer
+            args += ["--exclude=/%s" % path for path in self.hostFiles.get(seed, [])]
+        args.append(self.getSeedSource(seed))
+        args.append(self.getDestination(host))
+        # Forward the agent, the seed connects to its peers as we would
+        ssh = self.sshCommandLine(seed)
+        ssh.insert(1, "-A")
+        try:
+            with self.timer.phase("relay", host):
+                output = self.bexecute(ssh + [" ".join([pipes.quote(arg) for arg in args])])
+                if self.options.verbose:
+                    self.printHostOutput(host, output)
+        except ExecuteFailed, e:
+            raise DeploymentFailed("Failed to relay %s from %s to remote host %s" % (self.profile.appName, seed, host), e)
+
+    def pushHostFiles(self, host, paths):
+        """Push files from the tree of the host, once it got the tree of its
+        seed.  Paths missing from the tree are deleted on the host."""
+        args = self.getSyncCommandLine(host)
+        args += ["--files-from=%s" % self.writeHostFileList(host, paths), "--from0", "--delete-missing-args"]
+        args.append(self.getSource(host))
+        args.append(self.getDestination(host))
+        try:
+            with self.timer.phase("push", host):
+                output = self.bexecute(args)
+                if self.options.verbose:
+                    self.printHostOutput(host, output)
+        except ExecuteFailed, e:
+            raise DeploymentFailed("Failed to push the files of %s to remote host %s" % (self.profile.appName, host), e)
+
+    def getSeedSource(self, seed):
+        """@return the directory holding the new tree on the seed host"""
+        if self.profile.releaseLayout:
+            if seed in self.activatedHosts:
+                # Activated in an earlier wave, staged releases are renamed
+                return "%s/" % self.getRemoteReleaseDir(self.newRevision)
+            return "%s/" % self.getRemoteReleaseDir(self.getReleaseName(seed))
+        return "%s/" % self.profile.remoteDir
+
+    def getFanOutSeeds(self):
+        """@return dictionary mapping hosts to the seed host they are relayed
+                   from"""
+        seeds = {}
+        for group in self.profile.fanOut or []:
+            for host in group[1:]:
+                seeds[host] = group[0]
+        return seeds
+
+    def pushToHosts(self, hosts):
+        """Push to the hosts, relaying to the peers of each fan-out group from
+        its seed host once the seed got the push.  A peer is pushed to
+        directly if its seed is not deployed.
+
+        @return list of TaskResult, one per host, in the order of hosts
+        """
+        hosts = list(hosts)
+        seeds = self.getFanOutSeeds()
+        if seeds and self.profile.hostOverlays and not(self.profile.useRsync):
+            raise DeploymentFailed("hostOverlays with fanOut requires useRsync")
+        deployed = set(self.deployedHosts or [])
+        relayed = [host for host in hosts if host in seeds and (seeds[host] in hosts or seeds[host] in deployed)]
+
+        results = dict([(r.item, r) for r in self.runOnHosts(self.pushToHost, [host for host in hosts if host not in relayed])])
+        failed = [r for r in results.values() if r.error is not None]
+
+        if relayed:
+            if failed and self.options.failFast:
+                for host in relayed:
+                    results[host] = TaskResult(host)
+                    results[host].error = TaskCancelled("Not run because of a previous failure")
+            else:
+                seeded = deployed | set([host for (host, r) in results.items() if r.succeeded()])
+                def push(host):
+                    if seeds[host] in seeded:
+                        self.relayToHost(seeds[host], host)
+                    else:
+                        self.pushToHost(host)
+                for r in self.runOnHosts(push, relayed):
+                    results[r.item] = r
+
+        return [results[host] for host in hosts]
+
+    def afterPushHost(self, host):
+        try:
+            with self.timer.phase("afterPush", host):
+                self.afterPush(host)
+        except ExecuteFailed, e:
+            raise DeploymentFailed("Failed to run %s after-push hook on remote host %s" % (self.profile.appName, host), e)
+
+    def getWaveSize(self, spec, total):
+        if isinstance(spec, basestring) and spec.endswith("%"):
+            return max(1, int(math.ceil(total * float(spec[:-1]) / 100)))
+        return max(1, int(spec))
+
+    def getRolloutPlan(self):
+        """Split the hosts into the waves defined by the canary and waves
+        settings of the profile
+
+        @return list of lists of hosts
+        """
+        hosts = list(self.getHosts())
+        plan = []
+
+        canary = self.profile.canary
+        if canary is not None and canary in hosts:
+            plan.append([canary])
+            hosts.remove(canary)
+
+        if not(self.profile.waves):
+            if hosts:
+                plan.append(hosts)
+            return plan
+
+        total = len(hosts)
+        index = 0
+        while hosts:
+            spec = self.profile.waves[min(index, len(self.profile.waves) - 1)]
+            size = self.getWaveSize(spec, total)
+            plan.append(hosts[:size])
+            hosts = hosts[size:]
+            index += 1
+
+        return plan
+
+    def getExpectedRevision(self, host):
+        """@return the revision the host should serve once deployed or rolled
+                   back"""
+        if host in self.rolledBackReleases:
+            return self.rolledBackReleases[host]
+        return self.newRevision
+
+    def checkHealth(self, host):
+        """Wait until the host serves the new revision, or the release it was
+        rolled back to, as configured by the healthCheck setting of the
+        profile.  Override to implement other health checks.
+
+        @raise DeploymentFailed if the host is not healthy in time
+        """
+        (port, uri) = self.profile.healthCheck
+        deadline = time.time() + self.profile.healthCheckTimeout
+        expected = self.getExpectedRevision(host)
+        while True:
+            try:
+                rev = self.fetchCurrentDeployedRevisionHTTP(host, port, uri)
+                if rev == expected:
+                    return
+                problem = "serves revision %s" % rev
+            except UnknownRevision, e:
+                problem = str(e)
+            if time.time() >= deadline:
+                raise DeploymentFailed("Host %s is not healthy after %s seconds: %s" % (host, self.profile.healthCheckTimeout, problem))
+            time.sleep(2)
+
+    def checkHostHealth(self, host):
+        with self.timer.phase("healthCheck", host):
+            self.checkHealth(host)
+
+    def getMaxUnavailable(self):
+        spec = self.options.maxUnavailable
+        if spec is None:
+            spec = self.profile.maxUnavailable
+        return self.getWaveSize(spec, len(list(self.getHosts())))
+
+    def checkReadiness(self, host):
+        """Wait until the host is back in service after its after-push hook.
+        Defaults to the health check of the profile, if any.
+
+        @raise DeploymentFailed if the host is not ready in time
+        """
+        if self.profile.healthCheck is not None:
+            self.checkHostHealth(host)
+
+    def restartHost(self, host, aborted):
+        if aborted.isSet():
+            raise TaskCancelled("Not restarted because a previous host did not come back")
+        with self.timer.phase("restart", host):
+            self.afterPushHost(host)
+            try:
+                self.checkReadiness(host)
+            except DeploymentFailed, e:
+                # Stop taking more hosts out of service
+                aborted.set()
+                raise HostNotReady("Host %s is not ready after its after-push hook" % host, e)
+
+    def restartHosts(self, hosts):
+        """Run the after-push hooks, keeping at most getMaxUnavailable() hosts
+        out of service at a time: a host frees its slot once it passed
+        checkReadiness()
+
+        @return list of TaskResult, one per host.  Readiness failures are
+                reported as HostNotReady errors.
+        """
+        hosts = list(hosts)
+        if not(hosts):
+            return []
+
+        maxUnavailable = self.getMaxUnavailable()
+        if maxUnavailable > 1 and len(hosts) > 1:
+            print " Restarting up to %s hosts at a time" % maxUnavailable
+
+        aborted = threading.Event()
+        results = runConcurrently(lambda host: self.restartHost(host, aborted), hosts, maxUnavailable, self.options.failFast)
+
+        latencies = ["%s %.1fs" % (r.item, r.duration) for r in results if r.succeeded()]
+        if latencies:
+            print " Restart latency: %s" % ", ".join(latencies)
+        return results
+
     def pushToRemoteHosts(self):
         print
         print "Pushing to remote hosts"
-        for host in self.getHosts():
-            # Give a last chance to customize workdir for host
-            self.beforePushHost(host)
+        if self.options.parallel > 1:
+            print " Using up to %s concurrent pushes" % self.options.parallel
 
-            print " Pushing to %s" % host
+        plan = self.getRolloutPlan()
+        self.deployedHosts = []
+        # Failures kept when continuing on error, raised at the end
+        errors = []
 
-            try:
-                args = self.getSyncCommandLine(host)
-                args.append(self.getSource(host))
-                args.append(self.getDestination(host))
-                self.bvexecute(args)
-            except OSError, e:
-                if e.errno == 2:
-                    raise DeploymentFailed("useRsync=%s but %s is not installed" % (self.profile.useRsync, args[0]))
-            except ExecuteFailed, e:
-                raise DeploymentFailed("Failed to push %s to remote host %s" % (self.profile.appName, host), e)
+        for (index, wave) in enumerate(plan):
+            if len(plan) > 1:
+                print
+                print "Rollout wave %s/%s: %s" % (index + 1, len(plan), ", ".join(wave))
 
-        if self.options.doNotify and (self.profile.recipient or self.options.forceRecipient):
-            self.notify()
+            results = self.pushToHosts(wave)
+            pushed = [r.item for r in results if r.succeeded()]
+            self.deployedHosts += pushed
 
-        for host in self.getHosts():
             try:
-                self.afterPush(host)
-            except ExecuteFailed, e:
-                raise DeploymentFailed("Failed to run %s after-push hook on remote host %s" % (self.profile.appName, host), e)
+                self.checkHostResults("Push", results)
+            except DeploymentFailed:
+                if self.options.failFast or not(self.deployedHosts):
+                    raise
+                errors.append(sys.exc_info())
+
+            if self.profile.releaseLayout:
+                results = self.runOnHosts(self.activateReleaseOnHost, pushed)
+                pushed = [r.item for r in results if r.succeeded()]
+                try:
+                    self.checkHostResults("Release activation", results)
+                except DeploymentFailed:
+                    if self.options.failFast:
+                        raise
+                    errors.append(sys.exc_info())
+
+            if index == len(plan) - 1 and self.options.doNotify and (self.profile.recipient or self.options.forceRecipient):
+                with self.timer.phase("notify"):
+                    self.notify()
+
+            results = self.restartHosts(pushed)
+            notReady = [r for r in results if isinstance(r.error, HostNotReady)]
 
-    def rsyncArgs(self, host):
+            try:
+                self.checkHostResults("After-push hook", [r for r in results if r not in notReady])
+            except DeploymentFailed:
+                if self.options.failFast:
+                    raise
+                errors.append(sys.exc_info())
+
+            if notReady:
+                try:
+                    self.checkHostResults("Health check", notReady)
+                except DeploymentFailed, e:
+                    remaining = [host for w in plan[index + 1:] for host in w]
+                    if remaining:
+                        raise DeploymentFailed("Aborting rollout after wave %s/%s, not deployed to %s" % (index + 1, len(plan), ", ".join(remaining)), e)
+                    raise
+
+        if errors:
+            # Report every failure, the first one is raised
+            for (type, value, tb) in errors[1:]:
+                print >> sys.stderr, "ERROR: %s" % value
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def rsyncArgs(self, host, seed=None):
         args = []
 
         if self.options.verbose:
@@ -335,15 +1998,30 @@ class BaseDeploymentEngine(object):
 
         args += ['-rclz', '--delete']
 
+        # Master connections only exist on this machine
+        if seed is None:
+            sshOptions = self.connections.options(self.profile.remoteUser, host)
+            if sshOptions:
+                args += ['-e', " ".join(["ssh"] + sshOptions)]
+
         return args
 
-    def unisonArgs(self, host):
+    def unisonArgs(self, host, seed=None):
         args = []
 
         if self.options.verbose:
             args += ["-logfile", "/dev/stdout"]
 
-        args += ['-batch', '-dumbtty', '-silent', '-force', self.getSource(host)]
+        if seed is None:
+            source = self.getSource(host)
+        else:
+            source = self.getSeedSource(seed)
+        args += ['-batch', '-dumbtty', '-silent', '-force', source]
+
+        if seed is None:
+            sshOptions = self.connections.options(self.profile.remoteUser, host)
+            if sshOptions:
+                args += ['-sshargs', " ".join(sshOptions)]
 
         return args
 
@@ -351,9 +2029,25 @@ class BaseDeploymentEngine(object):
     def rsyncOptions(self, host):
         return []
 
+    def sshCommandLine(self, host, user=None):
+        """Build the ssh command line to run a command on the host, through
+        the shared master connection.  Use it in afterPush() hooks, eg:
+
+            self.bvexecute(self.sshCommandLine(host) + ["sudo", "service", "foo", "restart"])
+
+        @param user defaults to the remoteUser of the profile
+        """
+        if user is None:
+            user = self.profile.remoteUser
+        args = ["ssh"] + self.connections.options(user, host)
+        if user:
+            args += ["-l", user]
+        args.append(host)
+        return args
+
     def fetchCurrentDeployedRevisionSSH(self, host):
         try:
-            return self.bexecute(["ssh", "-l", self.profile.remoteUser, host, "cat", "%s/rev.txt" % self.profile.remoteDir])
+            return self.bexecute(self.sshCommandLine(host) + ["cat", "%s/rev.txt" % self.getRemoteRoot()])
         except Exception, e:
             raise UnknownRevision(repr(e))
 
@@ -378,18 +2072,104 @@ class BaseDeploymentEngine(object):
         return body.rstrip()
 
     def fetchCurrentDeployedRevision(self):
+        """Probe all hosts concurrently for their deployed revision, giving up
+        on hosts that did not answer within options.probeTimeout seconds
+
+        @return dictionary mapping each host to its deployed revision, or to
+                None when it could not be determined
+        """
+        hosts = list(self.getHosts())
+        revisions = {}
+        if self.options.trustState:
+            revisions = self.getRecordedRevisions(hosts)
+            hosts = [host for host in hosts if host not in revisions]
+            self.trustedHosts = sorted(revisions.keys())
+
+        results = runConcurrently(self.fetchDeployedRevision, hosts, len(hosts), False, self.options.probeTimeout)
+
+        probed = {}
+        for result in results:
+            if result.succeeded():
+                revisions[result.item] = probed[result.item] = result.value.rstrip()
+            elif isinstance(result.error, (UnknownRevision, TaskTimeout)):
+                revisions[result.item] = None
+            else:
+                raise result.excInfo[0], result.excInfo[1], result.excInfo[2]
+        self.updateState(lambda store: store.setHostRevisions(self.getRemoteRoot(), probed, self.profile.appName, self.profile.name, getOperator(), "probe"))
+        return revisions
+
+    def getRecordedRevisions(self, hosts):
+        """@return dictionary mapping hosts to the revision recorded in the
+                   state store less than options.stateMaxAge seconds ago"""
+        store = self.getStateStore()
+        if store is None:
+            return {}
+        try:
+            recorded = store.getHostRevisions(self.getRemoteRoot(), hosts, self.options.stateMaxAge)
+        except sqlite3.Error, e:
+            print >> sys.stderr, "WARNING: Could not read deployment state: %s" % e
+            return {}
+        return dict([(host, revision) for (host, (revision, age)) in recorded.items()])
+
+    def getStateStore(self):
+        if self.stateStore is None:
+            self.stateStore = getStateStore(self.options)
+        return self.stateStore
+
+    def updateState(self, fun):
+        """Call fun(store) with the state store, a failure to record the state
+        never fails the deployment"""
+        store = self.getStateStore()
+        if store is None:
+            return
+        try:
+            fun(store)
+        except sqlite3.Error, e:
+            print >> sys.stderr, "WARNING: Could not record deployment state: %s" % e
+
+    def recordDeployment(self):
+        """Record the outcome of the deployment, and the revision now deployed
+        on each host"""
+        if self.success:
+            outcome = "success"
+        elif self.cancelled:
+            outcome = "cancelled"
+        else:
+            outcome = "failed"
+        newRevision = getattr(self, 'newRevision', None)
+        hosts = list(self.getHosts())
+
+        def record(store):
+            remoteRoot = self.getRemoteRoot()
+            if self.deployedHosts is not None:
+                if self.success:
+                    store.setHostRevisions(remoteRoot, dict([(host, newRevision) for host in self.deployedHosts]), self.profile.appName, self.profile.name, getOperator())
+                else:
+                    # Hosts may be anywhere between both revisions
+                    store.forgetHosts(remoteRoot, hosts)
+            store.addDeployment(self.profile.appName, self.profile.name, getattr(self, 'oldRevision', None), newRevision, self.deployedHosts or [], getOperator(), self.timer.started, self.timer.total(), outcome)
+        self.updateState(record)
+
+    def getOldRevision(self, revisions):
+        """Print warnings about hosts with an unknown or diverging revision
+
+        @param revisions dictionary as returned by fetchCurrentDeployedRevision()
+        @return the last known deployed revision, in host order, or None
+        """
         last_known_rev = None
 
         for host in self.getHosts():
-            try:
-                rev = self.fetchDeployedRevision(host).rstrip()
-            except UnknownRevision:
+            rev = revisions.get(host)
+            if rev is None:
                 print " * WARNING * could not get deployed revision from host %s" % host
                 continue
-            if last_known_rev and rev != last_known_rev:
-                print " * WARNING * Web server %s has revision %s, differs from last known revision %s" % (host, rev, last_known_rev)
             last_known_rev = rev
 
+        for host in self.getHosts():
+            rev = revisions.get(host)
+            if rev is not None and rev != last_known_rev:
+                print " * WARNING * Web server %s has revision %s, differs from last known revision %s" % (host, rev, last_known_rev)
+
         return last_known_rev
 
     def fetchDeployedRevision(self, host):
@@ -397,42 +2177,56 @@ class BaseDeploymentEngine(object):
         for fetching the deployed revision for the specified host"""
         return self.fetchCurrentDeployedRevisionSSH(host)
 
-    def execute(self, args, cwd=None):
+    def execute(self, args, cwd=None, timeout=None):
         """Execute with unbuffered stdout and stderr"""
         if self.options.verbose:
-            print "Executing command: %s" % (' '.join(args))
-        p = subprocess.Popen(args, cwd=cwd)
-        sc = p.wait()
-        if sc != 0:
-            raise ExecuteFailed("Command '%s' returned status code %s" % (" ".join(args), sc))
-
-    def bvexecute(self, args, cwd=None):
+            self.say("Executing command: %s" % (' '.join(args)))
+
+        def passthrough(stream):
+            def write(line):
+                with self.outputLock:
+                    stream.write(line)
+                    stream.flush()
+            return write
+
+        r = runCommand(args, cwd, passthrough(sys.stdout), passthrough(sys.stderr), timeout, closeStdin=False)
+        if r.timedOut:
+            raise ExecuteFailed("Command '%s' timed out after %s seconds" % (" ".join(args), timeout))
+        if r.status != 0:
+            raise ExecuteFailed("Command '%s' returned status code %s" % (" ".join(args), r.status))
+
+    def bvexecute(self, args, cwd=None, timeout=None):
         """Execute without a result"""
         if self.options.verbose:
-            self.execute(args, cwd)
+            self.execute(args, cwd, timeout)
             return
 
-        self.bexecute(args, cwd)
+        self.bexecute(args, cwd, timeout, lambda line: None)
 
-    def bexecute(self, args, cwd=None):
-        """Execute with buffered stdout and stderr and return stdout contents.  Upon error, both stdout and stderr contents are included in the exception message"""
+    def bexecute(self, args, cwd=None, timeout=None, onLine=None):
+        """Execute with buffered stdout and stderr and return stdout contents.  Upon error, the last lines of both stdout and stderr are included in the exception message.
+
+        @param onLine if set, stdout lines are passed to this function as they
+                      are read instead of being returned, to process large
+                      outputs without holding them in memory
+        """
         if self.options.verbose:
-            print "Executing command: %s" % (' '.join(args))
-        o = StringIO.StringIO()
-        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
-        p.stdin.close()
+            self.say("Executing command: %s" % (" ".join(args)))
 
-        # Keep reading output to avoid deadlock when internal buffer is full
-        while True:
-            line = p.stdout.read()
-            if line == "":
-                break
-            o.write(line)
+        o = None
+        if onLine is None:
+            o = StringIO.StringIO()
+            onLine = o.write
 
-        sc = p.wait()
-        if sc != 0:
-            raise ExecuteFailed("Command '%s' returned status code %s\n\nCommand output:\n------------------------------------------------------------------------\n%s------------------------------------------------------------------------\nError messages:\n------------------------------------------------------------------------\n%s------------------------------------------------------------------------" % (" ".join(args), sc, o.getvalue(), p.stderr.read()))
-        return o.getvalue()
+        r = runCommand(args, cwd, onLine, None, timeout)
+        if r.timedOut:
+            raise ExecuteFailed("Command '%s' timed out after %s seconds\n\nCommand output:\n------------------------------------------------------------------------\n%s------------------------------------------------------------------------\nError messages:\n------------------------------------------------------------------------\n%s------------------------------------------------------------------------" % (" ".join(args), timeout, r.getStdoutTail(), r.getStderrTail()))
+        if r.status != 0:
+            raise ExecuteFailed("Command '%s' returned status code %s\n\nCommand output:\n------------------------------------------------------------------------\n%s------------------------------------------------------------------------\nError messages:\n------------------------------------------------------------------------\n%s------------------------------------------------------------------------" % (" ".join(args), r.status, r.getStdoutTail(), r.getStderrTail()))
+
+        if o is not None:
+            return o.getvalue()
+        return None
 
     def checkout(self, repo):
         """Checkout a Git repository
@@ -441,22 +2235,249 @@ class BaseDeploymentEngine(object):
         """
         print
         print "Checking out %s into %s" % (repo, self.workdir)
-        self.bvexecute(["git", "clone", "-n", repo, self.workdir])
+        if repo == self.mirror:
+            # Borrow objects from the mirror instead of copying them
+            self.bvexecute(["git", "clone", "-n", "--shared", repo, self.workdir])
+        elif self.options.shallowClone:
+            # Nothing is fetched until reset() knows the revision
+            self.shallow = True
+            self.bvexecute(["git", "init", "-q", self.workdir])
+            self.bvexecute(["git", "remote", "add", "origin", repo], cwd=self.workdir)
+            if self.getCloneFilter(repo):
+                # Fetch missing file contents from origin whenever needed
+                self.bvexecute(["git", "config", "remote.origin.promisor", "true"], cwd=self.workdir)
+                self.bvexecute(["git", "config", "remote.origin.partialclonefilter", self.getCloneFilter(repo)], cwd=self.workdir)
+        else:
+            self.bvexecute(["git", "clone", "-n", repo, self.workdir])
+
+    def getCloneFilter(self, repo):
+        """@return the object filter of shallow clones, or None for local
+                   repositories which do not filter anything"""
+        if os.path.exists(repo):
+            return None
+        return "blob:none"
+
+    def fetchArgs(self):
+        args = ["git", "fetch", "-q"]
+        if self.getCloneFilter(self.profile.repositoryPath):
+            args.append("--filter=%s" % self.getCloneFilter(self.profile.repositoryPath))
+        return args
+
+    def fetchShallow(self):
+        """Fetch what a shallow workdir needs before the revision is reset:
+        every tag for a profile that selects one, the requested revision
+        otherwise, so that it resolves like in a full clone"""
+        if self.profile.selectTag:
+            print " Fetching tags"
+            self.bexecute(self.fetchArgs() + ["--depth=1", "origin", "+refs/tags/*:refs/tags/*"], cwd=self.workdir)
+            return
+        revision = self.profile.getRevision()
+        if revision is not None:
+            self.fetchRevision(revision)
+
+    def fetchRevision(self, revision):
+        """Fetch the single commit of the requested revision into a shallow
+        workdir, trying it as a tag, a branch and a commit hash in turn.  An
+        abbreviated hash can only be resolved with the whole history."""
+        if revision.startswith("origin/"):
+            branch = revision[len("origin/"):]
+            candidates = [("+refs/heads/%s:refs/remotes/origin/%s" % (branch, branch), None)]
+        else:
+            candidates = [("+refs/tags/%s:refs/tags/%s" % (revision, revision), None), ("+refs/heads/%s:refs/remotes/origin/%s" % (revision, revision), revision), (revision, None)]
+        for (refspec, branch) in candidates:
+            try:
+                self.bexecute(self.fetchArgs() + ["--depth=1", "origin", refspec], cwd=self.workdir)
+            except ExecuteFailed:
+                continue
+            if branch is not None:
+                # A full clone has a local branch, at least for the default
+                # branch, that plain branch names resolve to
+                self.bexecute(["git", "update-ref", "refs/heads/%s" % branch, "refs/remotes/origin/%s" % branch], cwd=self.workdir)
+            self.shallowRefspec = refspec
+            self.fetchedRevision = revision
+            return
+        print " Could not fetch %s alone, fetching the whole history" % revision
+        self.bvexecute(self.fetchArgs() + ["origin", "+refs/heads/*:refs/remotes/origin/*", "+refs/tags/*:refs/tags/*"], cwd=self.workdir)
+        self.fetchedRevision = revision
+
+    def isShallow(self):
+        return self.bexecute(["git", "rev-parse", "--is-shallow-repository"], cwd=self.workdir).strip() == "true"
+
+    def deepenUntilReachable(self, revision):
+        """Deepen the history of a shallow workdir, doubling the number of
+        fetched commits each time, until the revision is an ancestor of HEAD
+        or the whole history is fetched"""
+        depth = 50
+        while True:
+            try:
+                self.bexecute(["git", "merge-base", "--is-ancestor", revision, "HEAD"], cwd=self.workdir)
+                return
+            except ExecuteFailed:
+                pass
+            if self.shallowRefspec is None or not(self.isShallow()):
+                return
+            print " Fetching %s more commits to reach revision %s" % (depth, revision)
+            self.bexecute(self.fetchArgs() + ["--deepen=%s" % depth, "origin", self.shallowRefspec], cwd=self.workdir)
+            depth *= 2
+
+    def getTagIndex(self):
+        if self.tagIndex is None:
+            self.tagIndex = TagIndex(os.path.join(self.options.cacheDir, "tags", "%s.json" % cacheKey(self.profile.repositoryPath, self.profile.repositoryPath)))
+            self.tagIndex.update(self.gitdir, lambda: [x.rstrip() for x in self.bexecute(["git", "tag", "-l"], cwd=self.gitdir).split("\n") if x])
+        return self.tagIndex
 
     def getTags(self, pattern):
         # Reverse sort by version number
-        return sorted([x.rstrip() for x in self.bvexecute(["git", "tag", "-l", pattern], cwd=self.workdir).split("\n") if x], version_compare, None, True)
+        return self.getTagIndex().match(pattern)
+
+    def getAllowedTags(self):
+        """@return tags that can be selected on a profile with selectTag, by
+                   decreasing version"""
+        if self.profile.branch is None:
+            return self.getTags("*")
+        return self.getTags("%s.*" % self.profile.branch)
 
     def reset(self, revision):
+        """Materialize the requested revision in the workdir
+
+        @return abbreviated Git revision number
+        """
+        if self.options.exportTree:
+            return self.export(revision)
+
+        if self.shallow and self.fetchedRevision != revision:
+            # Eg a tag selected after prepare()
+            with self.timer.phase("fetch"):
+                self.fetchRevision(revision)
         self.bvexecute(["git", "reset", "--hard", revision], cwd=self.workdir)
         return self.bexecute(["git", "show", "-s", "--pretty=format:%h"], cwd=self.workdir).rstrip()
 
+    def getArtifactCache(self):
+        return DirectoryCache(os.path.join(self.options.cacheDir, "artifacts"), self.options.artifactCacheSize * 1024 * 1024)
+
+    def getArtifactOptions(self):
+        """Override to add the options and profile settings that beforePush()
+        depends on, so that they are part of the artifact cache key
+
+        @return tuple of values
+        """
+        return (self.options.doMinify, self.profile.minifyAssets, tuple(self.profile.minifyExclude))
+
+    def getArtifactKey(self, revision):
+        commit = self.resolveRevision(revision)
+        engine = "%s.%s" % (self.__class__.__module__, self.__class__.__name__)
+        return cacheKey(self.__class__.__name__, commit, engine, repr(self.getArtifactOptions()))
+
+    def findArtifact(self, key):
+        """Look for a tree prepared by a previous deployment of the same
+        revision with the same engine and options
+
+        @return cache key of the artifact, or None
+        """
+        cache = self.getArtifactCache()
+        if not(cache.exists(key)):
+            return None
+        return key
+
+    def restoreArtifact(self, key):
+        """Copy a cached artifact into the workdir, instead of running
+        reset() and beforePush()
+
+        @return abbreviated Git revision number
+        """
+        cache = self.getArtifactCache()
+        print
+        print "Using cached artifact %s" % key
+        with cache.lock(key):
+            if not(os.path.exists(self.workdir)):
+                os.mkdir(self.workdir)
+            # Copy rather than hard-link, so that beforePushHost() can not
+            # alter the cached artifact
+            self.bvexecute(["cp", "-a", "%s/." % cache.path(key), self.workdir])
+            cache.touch(key)
+        with open("%s/rev.txt" % self.workdir) as f:
+            return f.read().strip()
+
+    def storeArtifact(self, key):
+        """Save the prepared workdir in the artifact cache, and evict the least
+        recently used artifacts if the cache grew too large"""
+        cache = self.getArtifactCache()
+        with cache.lock(key):
+            cache.remove(key)
+            tmp = "%s.tmp" % cache.path(key)
+            self.bvexecute(["cp", "-a", self.workdir, tmp])
+            # The changelog depends on the deployed revision, not on the tree
+            if os.path.exists("%s/changelog.txt" % tmp):
+                os.unlink("%s/changelog.txt" % tmp)
+            os.rename(tmp, cache.path(key))
+            cache.commit(key)
+
+        for evicted in cache.evict(keep=[key]):
+            print " Evicted unused artifact %s" % evicted
+
+    def resolveRevision(self, revision):
+        """@return full Git commit id of the requested revision"""
+        if self.gitdir == self.profile.repositoryPath and self.gitdir != self.mirror and revision.startswith("origin/"):
+            # Branches of the repository are origin/* in its clones
+            revision = "refs/heads/%s" % revision[len("origin/"):]
+        try:
+            return self.bexecute(["git", "rev-parse", "--verify", "%s^{commit}" % revision], cwd=self.gitdir).strip()
+        except ExecuteFailed, e:
+            raise DeploymentFailed("Unknown revision %s" % revision, e)
+
+    def export(self, revision):
+        """Extract the tree of the requested revision from the mirror straight
+        into the workdir, without any Git metadata.  Like git archive, this
+        honors the export-ignore and export-subst attributes.
+
+        @return abbreviated Git revision number
+        """
+        commit = self.resolveRevision(revision)
+
+        print
+        print "Exporting revision %s into %s" % (revision, self.workdir)
+        os.mkdir(self.workdir)
+        archiveArgs = ["git", "archive", "--format=tar", commit]
+        tarArgs = ["tar", "-x", "-C", self.workdir]
+        if self.options.verbose:
+            self.say("Executing command: %s | %s" % (" ".join(archiveArgs), " ".join(tarArgs)))
+        archive = subprocess.Popen(archiveArgs, cwd=self.gitdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        tar = subprocess.Popen(tarArgs, stdin=archive.stdout, stderr=subprocess.PIPE)
+        # Let git archive receive SIGPIPE if tar exits early
+        archive.stdout.close()
+        tarErrors = tar.stderr.read()
+        tarStatus = tar.wait()
+        archiveErrors = archive.stderr.read()
+        archiveStatus = archive.wait()
+
+        if archiveStatus != 0 or tarStatus != 0:
+            raise ExecuteFailed("Command '%s | %s' returned status codes %s and %s\n\nError messages:\n------------------------------------------------------------------------\n%s%s------------------------------------------------------------------------" % (" ".join(archiveArgs), " ".join(tarArgs), archiveStatus, tarStatus, archiveErrors, tarErrors))
+
+        return self.bexecute(["git", "show", "-s", "--pretty=format:%h", commit], cwd=self.gitdir).rstrip()
+
+    def minify(self):
+        """Minify the JavaScript and CSS files of the workdir, reusing the
+        output of previous deployments for files that did not change"""
+        cache = MinifyCache(os.path.join(self.options.cacheDir, "minify"), self.options.minifyCacheSize * 1024 * 1024)
+        print
+        print "Minifying assets"
+        report = minifyTree(self.workdir, cache, self.options.minifyProcesses, self.profile.minifyExclude)
+        for ext in report.unsupported:
+            print " * WARNING * No minifier installed for %s files, please install %s" % (ext, {".js": "rjsmin", ".css": "rcssmin"}.get(ext, "one"))
+        for (path, error) in report.errors:
+            print " * WARNING * Could not minify %s: %s" % (path, error)
+        if report.errors:
+            raise DeploymentFailed("Could not minify %s files, use --skip-minify to deploy anyway" % len(report.errors))
+        print " Minified %s files, %s of them from cache: %s KB down to %s KB" % (report.minified + report.cached, report.cached, report.originalSize // 1024, report.minifiedSize // 1024)
+        cache.evict()
+
     def beforePush(self):
         """Called before pushing application to any host"""
         pass
 
     def beforePushHost(self, host):
-        """Called before pushing application to any host"""
+        """Called before pushing application to a single host, to customize
+        its tree with writeHostFile()"""
         pass
 
     def afterPush(self, host):
@@ -464,7 +2485,7 @@ class BaseDeploymentEngine(object):
         pass
 
     def unisonOptions(self, host):
-        pass
+        return []
 
 def getDeployment(profile, options):
     deployClass = profile.deploymentEngine
@@ -0,0 +1,123 @@
+import os, re, shutil, fcntl, hashlib, contextlib
+
+def cacheKey(name, *parts):
+    """Build a filesystem-safe cache key made of a readable name followed by
+    a digest of all the parts"""
+    digest = hashlib.sha1("\0".join([str(x) for x in (name,) + parts])).hexdigest()
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', os.path.basename(str(name).rstrip("/")))
+    return "%s-%s" % (name[:40], digest[:16])
+
+def diskUsage(path):
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+class DirectoryCache(object):
+    """Cache of directories stored under a common root and evicted in least
+    recently used order when their total size exceeds maxSize bytes.
+
+    Each entry <key> comes with a <key>.stamp file whose modification time is
+    the last time the entry was used and whose content is the size of the
+    entry, and a <key>.lock file used to serialize access between concurrent
+    deployments."""
+
+    def __init__(self, root, maxSize=None):
+        self.root = root
+        self.maxSize = maxSize
+        if not(os.path.isdir(root)):
+            os.makedirs(root)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key)) and os.path.exists(self.stampFile(key))
+
+    def stampFile(self, key):
+        return os.path.join(self.root, "%s.stamp" % key)
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        """Hold an exclusive lock on the entry for the duration of the with
+        block.  When not blocking, yield False instead of waiting if the
+        entry is locked by another process."""
+        f = open(os.path.join(self.root, "%s.lock" % key), "a")
+        try:
+            flags = fcntl.LOCK_EX
+            if not(blocking):
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(f, flags)
+            except IOError:
+                yield False
+                return
+            yield True
+        finally:
+            f.close()
+
+    def commit(self, key):
+        """Record the size of the entry and mark it as just used"""
+        with open(self.stampFile(key), "w") as f:
+            f.write("%s\n" % diskUsage(self.path(key)))
+
+    def touch(self, key):
+        os.utime(self.stampFile(key), None)
+
+    def remove(self, key):
+        for path in (self.stampFile(key), "%s.tmp" % self.path(key)):
+            if os.path.isfile(path):
+                os.unlink(path)
+            elif os.path.isdir(path):
+                shutil.rmtree(path)
+        if os.path.isdir(self.path(key)):
+            shutil.rmtree(self.path(key))
+
+    def entries(self):
+        """@return list of (last use time, size, key), least recently used first"""
+        entries = []
+        for filename in os.listdir(self.root):
+            if not(filename.endswith(".stamp")):
+                continue
+            key = filename[:-len(".stamp")]
+            path = os.path.join(self.root, filename)
+            try:
+                with open(path) as f:
+                    size = int(f.read().strip() or 0)
+                entries.append((os.stat(path).st_mtime, size, key))
+            except (IOError, OSError, ValueError):
+                continue
+        entries.sort()
+        return entries
+
+    def evict(self, keep=()):
+        """Remove least recently used entries until the cache fits in maxSize,
+        never removing the entries listed in keep nor entries locked by
+        another process
+
+        @return list of evicted keys
+        """
+        if self.maxSize is None:
+            return []
+
+        entries = self.entries()
+        total = sum([size for (mtime, size, key) in entries])
+        evicted = []
+
+        for (mtime, size, key) in entries:
+            if total <= self.maxSize:
+                break
+            if key in keep:
+                continue
+            with self.lock(key, blocking=False) as locked:
+                if not(locked):
+                    continue
+                self.remove(key)
+            total -= size
+            evicted.append(key)
+
+        return evicted
@@ -0,0 +1,203 @@
+import os, fnmatch, hashlib, multiprocessing
+
+# Optional minifiers: assets of a kind are left alone if its minifier is not
+# installed
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+# Seconds, only there so that waiting on the pool can be interrupted
+POOL_TIMEOUT = 86400
+
+def getMinifiers():
+    """@return dictionary mapping file extensions to (module, minify function
+               name) for the minifiers that are installed"""
+    minifiers = {}
+    if rjsmin is not None:
+        minifiers[".js"] = (rjsmin, "jsmin")
+    if rcssmin is not None:
+        minifiers[".css"] = (rcssmin, "cssmin")
+    return minifiers
+
+def findAssets(root, extensions, exclude=()):
+    """@return paths relative to root of the files with the given extensions,
+               except already minified files and those matching exclude
+               patterns"""
+    assets = []
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            (base, ext) = os.path.splitext(filename)
+            if ext not in extensions or base.endswith(".min"):
+                continue
+            if os.path.islink(os.path.join(dirpath, filename)):
+                # Never write through links
+                continue
+            path = os.path.relpath(os.path.join(dirpath, filename), root)
+            if [pattern for pattern in exclude if fnmatch.fnmatch(path, pattern)]:
+                continue
+            assets.append(path)
+    return assets
+
+class MinifyCache(object):
+    """Minified assets stored by digest of their content and of the version
+    of the minifier, evicted in least recently used order"""
+
+    def __init__(self, root, maxSize=None):
+        self.root = root
+        self.maxSize = maxSize
+
+    def key(self, content, ext):
+        (module, name) = getMinifiers()[ext]
+        return hashlib.sha1("%s\0%s\0%s" % (module.__name__, getattr(module, "__version__", ""), content)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """@return the cached minified content, or None"""
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                content = f.read()
+        except IOError:
+            return None
+        os.utime(path, None)
+        return content
+
+    def put(self, key, content):
+        path = self.path(key)
+        if not(os.path.isdir(os.path.dirname(path))):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Created meanwhile by another worker
+                pass
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.rename(tmp, path)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in maxSize
+
+        @return number of evicted entries
+        """
+        if self.maxSize is None or not(os.path.isdir(self.root)):
+            return 0
+        entries = []
+        for (dirpath, dirnames, filenames) in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum([size for (mtime, size, path) in entries])
+        evicted = 0
+        for (mtime, size, path) in entries:
+            if total <= self.maxSize:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        return evicted
+
+def minifyAsset(args):
+    """Minify a single file in place and store the result in the cache.  Runs
+    in the worker processes of minifyTree().
+
+    @return (path, original size, minified size, error message or None)
+    """
+    (root, path, cacheRoot) = args
+    filename = os.path.join(root, path)
+    try:
+        with open(filename) as f:
+            content = f.read()
+        ext = os.path.splitext(path)[1]
+        (module, name) = getMinifiers()[ext]
+        minified = getattr(module, name)(content)
+        MinifyCache(cacheRoot).put(MinifyCache(cacheRoot).key(content, ext), minified)
+        with open(filename, "w") as f:
+            f.write(minified)
+        return (path, len(content), len(minified), None)
+    except Exception, e:
+        return (path, 0, 0, "%s: %s" % (e.__class__.__name__, e))
+
+class MinifyReport(object):
+    def __init__(self):
+        self.minified = 0
+        self.cached = 0
+        self.originalSize = 0
+        self.minifiedSize = 0
+        # List of (path, error message)
+        self.errors = []
+        # Extensions of the assets left alone for lack of a minifier
+        self.unsupported = []
+
+def minifyTree(root, cache, processes=None, exclude=(), extensions=(".js", ".css")):
+    """Minify the JavaScript and CSS files found under root in place.  Files
+    whose content is in the cache are replaced without running the minifier,
+    the others are minified by a pool of processes.
+
+    @param cache MinifyCache
+    @param processes size of the pool, the number of CPUs by default
+    @return MinifyReport
+    """
+    report = MinifyReport()
+    minifiers = getMinifiers()
+    report.unsupported = [ext for ext in extensions if ext not in minifiers]
+    supported = [ext for ext in extensions if ext in minifiers]
+
+    misses = []
+    for path in findAssets(root, supported, exclude):
+        filename = os.path.join(root, path)
+        with open(filename) as f:
+            content = f.read()
+        minified = cache.get(cache.key(content, os.path.splitext(path)[1]))
+        if minified is None:
+            misses.append((root, path, cache.root))
+            continue
+        with open(filename, "w") as f:
+            f.write(minified)
+        report.cached += 1
+        report.originalSize += len(content)
+        report.minifiedSize += len(minified)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if len(misses) <= 1 or processes <= 1:
+        results = map(minifyAsset, misses)
+    else:
+        pool = multiprocessing.Pool(min(processes, len(misses)))
+        try:
+            # Wait with a timeout so that the main thread still receives
+            # KeyboardInterrupt
+            results = pool.map_async(minifyAsset, misses, chunksize=8).get(POOL_TIMEOUT)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    for (path, originalSize, minifiedSize, error) in results:
+        if error is not None:
+            report.errors.append((path, error))
+            continue
+        report.minified += 1
+        report.originalSize += originalSize
+        report.minifiedSize += minifiedSize
+
+    return report
@@ -0,0 +1,196 @@
+import os, sys, time, json, fcntl, errno, threading, subprocess
+
+class NotificationSpool(object):
+    """Queue of outgoing messages stored as files under root, delivered by
+    piping each of them to a command such as sendmail.
+
+    A message that could not be delivered stays in the spool and is retried
+    with an exponential backoff, recorded in a <message>.state file, by this
+    or a later deployment.  After maxAttempts failures it is moved to the
+    failed/ subdirectory for a human to look at."""
+
+    def __init__(self, root, command, timeout=60, maxAttempts=8, initialDelay=5, maxDelay=3600):
+        self.root = root
+        self.command = command
+        self.timeout = timeout
+        self.maxAttempts = maxAttempts
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.counter = 0
+        if not(os.path.isdir(root)):
+            os.makedirs(root)
+
+    def enqueue(self, message):
+        """Store the message in the spool
+
+        @return path of the spooled message
+        """
+        self.counter += 1
+        name = "%.6f-%s-%s.msg" % (time.time(), os.getpid(), self.counter)
+        path = os.path.join(self.root, name)
+        tmp = "%s.tmp" % path
+        with open(tmp, "w") as f:
+            f.write(message)
+        # Only complete messages ever appear under their final name
+        os.rename(tmp, path)
+        return path
+
+    def pending(self):
+        """@return paths of the spooled messages, oldest first"""
+        return [os.path.join(self.root, filename) for filename in sorted(os.listdir(self.root)) if filename.endswith(".msg")]
+
+    def stateFile(self, path):
+        return "%s.state" % path
+
+    def getState(self, path):
+        try:
+            with open(self.stateFile(path)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'attempts': 0, 'nextAttempt': 0, 'lastError': None}
+
+    def nextAttempt(self, path):
+        return self.getState(path)['nextAttempt']
+
+    def deliver(self, path):
+        """Pipe the message to the delivery command
+
+        @return None on success, or the error message
+        """
+        with open(path) as f:
+            try:
+                p = subprocess.Popen(self.command, stdin=f, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except OSError, e:
+                return "Could not run '%s': %s" % (" ".join(self.command), e)
+            timer = threading.Timer(self.timeout, p.kill)
+            timer.start()
+            try:
+                output = p.communicate()[0]
+            finally:
+                timer.cancel()
+        if p.returncode != 0:
+            return "Command '%s' returned status code %s: %s" % (" ".join(self.command), p.returncode, output.strip())
+        return None
+
+    def process(self, path):
+        """Attempt to deliver a single message unless another process is
+        already doing so
+
+        @return True if the message left the spool
+        """
+        try:
+            f = open(path)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                # Delivered meanwhile by another deployment
+                return True
+            raise
+        try:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            if os.fstat(f.fileno()).st_nlink == 0:
+                return True
+
+            error = self.deliver(path)
+            if error is None:
+                os.unlink(path)
+                if os.path.exists(self.stateFile(path)):
+                    os.unlink(self.stateFile(path))
+                return True
+
+            state = self.getState(path)
+            state['attempts'] += 1
+            state['lastError'] = error
+            if state['attempts'] >= self.maxAttempts:
+                failed = os.path.join(self.root, "failed")
+                if not(os.path.isdir(failed)):
+                    os.makedirs(failed)
+                with open(self.stateFile(path), "w") as s:
+                    json.dump(state, s)
+                os.rename(path, os.path.join(failed, os.path.basename(path)))
+                os.rename(self.stateFile(path), os.path.join(failed, os.path.basename(self.stateFile(path))))
+                print >> sys.stderr, "WARNING: Giving up delivering notification %s after %s attempts: %s" % (path, state['attempts'], error)
+                return True
+
+            state['nextAttempt'] = time.time() + min(self.maxDelay, self.initialDelay * 2 ** (state['attempts'] - 1))
+            with open(self.stateFile(path), "w") as s:
+                json.dump(state, s)
+            return False
+        finally:
+            f.close()
+
+    def drain(self, stop=None):
+        """Deliver the messages that are due, oldest first
+
+        @param stop threading.Event interrupting the drain when set
+        @return time of the next due attempt, or None if the spool is empty
+        """
+        nextAttempt = None
+        for path in self.pending():
+            if stop is not None and stop.isSet():
+                break
+            due = self.nextAttempt(path)
+            if due > time.time() or not(self.process(path)):
+                due = max(self.nextAttempt(path), time.time() + self.initialDelay)
+                if nextAttempt is None or due < nextAttempt:
+                    nextAttempt = due
+        return nextAttempt
+
+class SpoolWorker(object):
+    """Background thread draining a NotificationSpool, woken up whenever a
+    message is sent"""
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        # Set when no message is due for delivery, either because the spool
+        # is empty or because the remaining messages wait for a retry
+        self.idle = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, message):
+        path = self.spool.enqueue(message)
+        with self.lock:
+            self.idle.clear()
+            self.wakeup.set()
+        return path
+
+    def loop(self):
+        while not(self.stopping.isSet()):
+            self.wakeup.clear()
+            try:
+                nextAttempt = self.spool.drain(self.stopping)
+            except (IOError, OSError), e:
+                print >> sys.stderr, "WARNING: Could not process notification spool %s: %s" % (self.spool.root, e)
+                nextAttempt = time.time() + self.spool.initialDelay
+            with self.lock:
+                if not(self.wakeup.isSet()):
+                    self.idle.set()
+            if nextAttempt is None:
+                self.wakeup.wait()
+            else:
+                self.wakeup.wait(max(0.1, nextAttempt - time.time()))
+
+    def close(self, timeout):
+        """Wait up to timeout seconds for every due message to be attempted,
+        then stop the worker.  Undelivered messages stay in the spool and are
+        retried by the next deployment.
+
+        @return number of messages left in the spool
+        """
+        deadline = time.time() + timeout
+        # Wait with a timeout so that the main thread still receives
+        # KeyboardInterrupt
+        while not(self.idle.isSet()) and time.time() < deadline:
+            self.idle.wait(min(0.1, max(0, deadline - time.time())))
+        self.stopping.set()
+        self.wakeup.set()
+        # A delivery in progress is left to finish in the background
+        self.thread.join(0.5)
+        return len(self.spool.pending())
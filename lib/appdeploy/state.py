@@ -0,0 +1,127 @@
+import os, time, sqlite3, contextlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS host_revisions (
+    host TEXT NOT NULL,
+    remote_dir TEXT NOT NULL,
+    application TEXT,
+    profile TEXT,
+    revision TEXT NOT NULL,
+    -- Seconds since the epoch
+    updated_at REAL NOT NULL,
+    operator TEXT,
+    -- "deploy" when recorded after pushing, "probe" when read from the host
+    source TEXT NOT NULL,
+    PRIMARY KEY (host, remote_dir)
+);
+
+CREATE TABLE IF NOT EXISTS deployments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    application TEXT,
+    profile TEXT,
+    old_revision TEXT,
+    new_revision TEXT,
+    hosts TEXT,
+    operator TEXT,
+    started_at REAL NOT NULL,
+    duration REAL,
+    -- "success", "failed" or "cancelled"
+    outcome TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS deployments_by_profile ON deployments (application, profile, started_at);
+"""
+
+class StateStore(object):
+    """Local SQLite database of the revision deployed on each host and of the
+    history of deployments.
+
+    Each operation opens its own connection, so that the store can be used
+    from any thread and by concurrent deployments."""
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        if not(os.path.isdir(os.path.dirname(path))):
+            os.makedirs(os.path.dirname(path))
+        with self.connect() as c:
+            c.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Yield a connection, committing on success"""
+        c = sqlite3.connect(self.path, timeout=self.timeout)
+        c.text_factory = str
+        try:
+            yield c
+            c.commit()
+        except:
+            c.rollback()
+            raise
+        finally:
+            c.close()
+
+    def getHostRevisions(self, remoteDir, hosts, maxAge=None):
+        """@return dictionary mapping hosts to (revision, age in seconds), for
+                   the hosts with a record younger than maxAge seconds"""
+        revisions = {}
+        now = time.time()
+        with self.connect() as c:
+            for host in hosts:
+                row = c.execute("SELECT revision, updated_at FROM host_revisions WHERE host = ? AND remote_dir = ?", (host, remoteDir)).fetchone()
+                if row is None:
+                    continue
+                age = now - row[1]
+                if maxAge is None or age <= maxAge:
+                    revisions[host] = (row[0], age)
+        return revisions
+
+    def setHostRevisions(self, remoteDir, revisions, application=None, profile=None, operator=None, source="deploy"):
+        """Record the revision deployed on hosts
+
+        @param revisions dictionary mapping hosts to their revision
+        """
+        now = time.time()
+        with self.connect() as c:
+            c.executemany("INSERT OR REPLACE INTO host_revisions (host, remote_dir, application, profile, revision, updated_at, operator, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(host, remoteDir, application, profile, revision, now, operator, source) for (host, revision) in revisions.items()])
+
+    def forgetHosts(self, remoteDir, hosts):
+        """Drop the records of hosts whose revision is no longer known, eg
+        after a failed deployment"""
+        with self.connect() as c:
+            c.executemany("DELETE FROM host_revisions WHERE host = ? AND remote_dir = ?", [(host, remoteDir) for host in hosts])
+
+    def addDeployment(self, application, profile, oldRevision, newRevision, hosts, operator, startedAt, duration, outcome):
+        with self.connect() as c:
+            c.execute("INSERT INTO deployments (application, profile, old_revision, new_revision, hosts, operator, started_at, duration, outcome) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (application, profile, oldRevision, newRevision, ",".join(hosts), operator, startedAt, duration, outcome))
+
+    def getLastDeployment(self, application, profile):
+        """@return dictionary describing the last deployment of the profile,
+                   or None"""
+        with self.connect() as c:
+            c.row_factory = sqlite3.Row
+            row = c.execute("SELECT * FROM deployments WHERE application = ? AND profile = ? ORDER BY started_at DESC LIMIT 1", (application, profile)).fetchone()
+        if row is None:
+            return None
+        return dict([(key, row[key]) for key in row.keys()])
+
+    def getHistory(self, application=None, profile=None, limit=20):
+        """@return list of dictionaries describing the last deployments,
+                   most recent first"""
+        query = "SELECT * FROM deployments"
+        conditions = []
+        params = []
+        if application is not None:
+            conditions.append("application = ?")
+            params.append(application)
+        if profile is not None:
+            conditions.append("profile = ?")
+            params.append(profile)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY started_at DESC LIMIT ?"
+        params.append(limit)
+        with self.connect() as c:
+            c.row_factory = sqlite3.Row
+            rows = c.execute(query, params).fetchall()
+        return [dict([(key, row[key]) for key in row.keys()]) for row in rows]
@@ -1,4 +1,7 @@
-import curses, time, curses.panel, textwrap, traceback, sys, os, syslog, appdeploy, getopt, collections
+import curses, time, curses.panel, textwrap, traceback, sys, os, syslog, appdeploy, getopt, collections, json, threading, sqlite3
+
+# Milliseconds to wait for a key before polling the current window
+POLL_INTERVAL = 200
 
 class UserCompleted(Exception):
     pass
@@ -8,6 +11,8 @@ class Window(object):
         self.pw = pw
         self.w = pw.derwin(1, 1)
         self.msgs = []
+        # Tag -> line where the tagged message was last painted
+        self.tagRows = {}
     def width(self):
         (maxy, maxx) = self.w.getmaxyx()
         return maxx
@@ -15,8 +20,8 @@ class Window(object):
         (maxy, maxx) = self.w.getmaxyx()
         return maxy
 
-    def echo(self, msg, attr=0):
-        self.msgs.append((msg, attr))
+    def echo(self, msg, attr=0, tag=None):
+        self.msgs.append((msg, attr, tag))
 
     def repaint(self):
         w = self.w
@@ -27,14 +32,26 @@ class Window(object):
         self.prepare()
         if len(self.msgs) > self.height():
             raise Exception("Too many messages to display: %s" % len(self.msgs))
-        for (msg, attr) in self.msgs[-(self.height())+1:]:
+        self.tagRows = {}
+        for (msg, attr, tag) in self.msgs[-(self.height())+1:]:
+            if tag is not None:
+                (y, x) = w.getyx()
+                self.tagRows[tag] = y
             msg = "%s" % msg
             w.addstr(str(msg), attr)
         self.decorate()
-        w.noutrefresh()
-        pw.noutrefresh()
+        self.update()
+
+    def update(self):
+        self.w.noutrefresh()
+        self.pw.noutrefresh()
         curses.doupdate()
 
+    def poll(self):
+        """Called periodically while waiting for a key, override to update the
+        window with results computed in the background"""
+        pass
+
     def reset(self):
         self.msgs = []
 
@@ -44,6 +61,13 @@ class Window(object):
     def prepare(self):
         pass
 
+    def handleKey(self, c):
+        """Override to handle keys other than enter and arrows
+
+        @return True if the key was handled
+        """
+        return False
+
 class ErrorWindow(Window):
     def __init__(self, pw):
         Window.__init__(self, pw)
@@ -61,36 +85,86 @@ class OptionsWindow(Window):
         Window.__init__(self, pw)
         self.selectedOption = None
         self.options = []
+        # Key -> (key label, message) of each option, as last painted
+        self.optionTexts = {}
+        # Called with the key of the option that gets highlighted
+        self.highlightHandler = None
+
+    def reset(self):
+        Window.reset(self)
+        self.options = []
+        self.optionTexts = {}
 
     def previousOption(self):
+        if not(self.options):
+            return
         if not(self.selectedOption):
-            self.selectedOption = self.options[-1]
+            self.moveHighlight(self.options[-1])
         else:
             index = self.options.index(self.selectedOption)
-            self.selectedOption = self.options[(index - 1) % len(self.options)]
-        self.repaint()
+            self.moveHighlight(self.options[(index - 1) % len(self.options)])
 
     def nextOption(self):
+        if not(self.options):
+            return
         if not(self.selectedOption):
-            self.selectedOption = self.options[0]
+            self.moveHighlight(self.options[0])
         else:
             index = self.options.index(self.selectedOption)
-            self.selectedOption = self.options[(index + 1) % len(self.options)]
-        self.repaint()
+            self.moveHighlight(self.options[(index + 1) % len(self.options)])
+
+    def moveHighlight(self, key):
+        previous = self.selectedOption
+        self.selectedOption = key
+        self.highlighted()
+        # Only the rows of both options change
+        if not(self.repaintOptions([previous, key])):
+            self.repaint()
 
     def addOption(self, key, msg, padding=1):
         self.options.append(key)
         f = "  %%%s.%ss    " % (padding, padding)
-        self.echo(f % str(key), curses.A_BOLD)
+        label = f % str(key)
+        # Keep each option on a single line, so that it can be repainted alone
+        msg = str(msg)[:max(0, self.width() - len(label) - 1)]
+        self.optionTexts[key] = (label, msg)
+        self.echo(label, curses.A_BOLD, tag=key)
+        self.echo("%s\n" % msg, self.optionAttr(key))
+
+    def optionAttr(self, key):
         if self.selectedOption == key:
-            attr = curses.A_STANDOUT
-        else:
-            attr = 0
-        self.echo("%s\n" % str(msg), attr)
+            return curses.A_STANDOUT
+        return 0
+
+    def repaintOptions(self, keys, texts={}):
+        """Repaint the rows of the given options only, with the new messages
+        given in texts if any
+
+        @return False if some option is not on screen, and the whole window
+                must be repainted instead
+        """
+        keys = [key for key in keys if key is not None]
+        if [key for key in keys if key not in self.tagRows or key not in self.optionTexts]:
+            return False
+        for key in keys:
+            (label, msg) = self.optionTexts[key]
+            if key in texts:
+                msg = str(texts[key])[:max(0, self.width() - len(label) - 1)]
+                self.optionTexts[key] = (label, msg)
+            self.w.move(self.tagRows[key], 0)
+            self.w.clrtoeol()
+            self.w.addstr(label, curses.A_BOLD)
+            self.w.addstr(msg, self.optionAttr(key))
+        self.decorate()
+        self.update()
+        return True
 
     def selectOption(self, key):
-        self.selectedOption = key
-        self.repaint()
+        self.moveHighlight(key)
+
+    def highlighted(self):
+        if self.highlightHandler is not None:
+            self.highlightHandler(self.selectedOption)
 
     def validateOption(self):
         if self.selectedOption:
@@ -117,53 +191,150 @@ class WelcomeScreen(OptionsWindow):
         self.addOption('q', "Quit deployment program")
 
 class SelectProfileScreen(OptionsWindow):
-    def __init__(self, pw, application):
+    """Lists the profiles of an application.  Rows are formatted once and
+    cached, dynamic revisions are resolved in the background and their rows
+    repainted when done."""
+
+    def __init__(self, pw, application, store=None):
         OptionsWindow.__init__(self, pw)
         self.application = application
-
-    def prepare(self):
-        self.reset()
-        self.echo("%s\n\n" % self.application['displayName'], curses.A_BOLD)
+        # Last deployment of each profile, read once from the state store
+        self.lastDeployments = {}
+        if store is not None:
+            for (profileKey, profile) in application['profiles']:
+                try:
+                    self.lastDeployments[profileKey] = store.getLastDeployment(profile.appName, profile.name)
+                except sqlite3.Error:
+                    pass
 
         maxlen = 0
-        format = "%%(name)-40.40s %%(revision)-20.20s %%(dhosts)-%s.%ss" % (maxlen, maxlen)
-
         for (profileKey, profile) in self.application['profiles']:
             if len(profile.hosts) == 0:
                 raise appdeploy.DeploymentFailed("Please define hosts for your deployment profile with key %s" % profileKey)
             if profile.name is None:
                 raise appdeploy.DeploymentFailed("Please define a name for your deployment profile with key %s" % profileKey)
-            hosts = ", ".join(profile.hosts)
-            if len(hosts) > maxlen:
-                maxlen = len(hosts)
-            format = "%(name)-40.40s %(revision)-20.20s"
-            format += " %%(dhosts)-%s.%ss" % (maxlen, maxlen)
+            maxlen = max(maxlen, len(", ".join(profile.hosts)))
+        self.format = "%(name)-40.40s %(revision)-20.20s %(last)-30.30s"
+        self.format += " %%(dhosts)-%s.%ss" % (maxlen, maxlen)
+
+        # Profile key -> BackgroundTask resolving its revision
+        self.resolving = {}
+        for (profileKey, profile) in self.application['profiles']:
+            if isinstance(profile.revision, tuple):
+                # All profiles resolve concurrently, sharing lookups through
+                # the resolver
+                self.resolving[profileKey] = appdeploy.BackgroundTask(profile.getRevision)
+        # Profile key -> formatted row
+        self.rows = {}
+
+    def formatLastDeployment(self, profileKey):
+        last = self.lastDeployments.get(profileKey)
+        if last is None:
+            return "-"
+        return "%s %s %s %ds" % (time.strftime("%m-%d %H:%M", time.localtime(last['started_at'])), last['operator'] or "?", last['outcome'], last['duration'] or 0)
+
+    def formatRevision(self, profileKey, profile):
+        task = self.resolving.get(profileKey)
+        if task is not None:
+            if not(task.result.done):
+                return "(resolving...)"
+            if task.result.error is not None:
+                return "(error)"
+        if profile.isRevisionUnknown():
+            return "(unknown)"
+        if profile.revision is None:
+            if profile.selectTag:
+                return ""
+            return "(unknown)"
+        return profile.revision
+
+    def getRow(self, profileKey, profile):
+        if profileKey not in self.rows:
+            self.rows[profileKey] = self.format % {
+                'name': profile.name,
+                'revision': self.formatRevision(profileKey, profile),
+                'last': self.formatLastDeployment(profileKey),
+                'dhosts': ", ".join(profile.hosts),
+            }
+        return self.rows[profileKey]
+
+    def prepare(self):
+        self.reset()
+        self.echo("%s\n\n" % self.application['displayName'], curses.A_BOLD)
 
         self.echo("       ")
-        self.echo(format % {'name': 'Name', 'revision': 'Revision', 'dhosts': "Hosts"})
+        self.echo(self.format % {'name': 'Name', 'revision': 'Revision', 'last': 'Last deployment', 'dhosts': "Hosts"})
         self.echo("\n\n")
 
         for (profileKey, profile) in self.application['profiles']:
-            profileDict = profile.asdict()
-            profileDict['dhosts'] = ", ".join(profile.hosts)
-            self.addOption(profileKey, format % profileDict)
+            self.addOption(profileKey, self.getRow(profileKey, profile))
 
         self.echo("\n\n\n\nOther options:\n\n")
         self.addOption('q', "Return to main screen")
 
+    def poll(self):
+        texts = {}
+        for (profileKey, profile) in self.application['profiles']:
+            task = self.resolving.get(profileKey)
+            if task is None or not(task.result.done):
+                continue
+            # Format the row again, now that the revision is known
+            self.rows.pop(profileKey, None)
+            texts[profileKey] = self.getRow(profileKey, profile)
+            del self.resolving[profileKey]
+        if texts and not(self.repaintOptions(texts.keys(), texts)):
+            self.repaint()
+
 class SelectTagScreen(OptionsWindow):
+    """Pages through the allowed tags, typing filters them incrementally"""
+
     def __init__(self, pw, d):
-        assert isinstance(d, appdeploy.Deployment)
+        assert isinstance(d, appdeploy.BaseDeploymentEngine)
         OptionsWindow.__init__(self, pw)
         self.d = d
+        self.filter = ""
+        self.page = 0
+
+    def pageSize(self):
+        # Each option takes two messages, and repaint() can display at most
+        # as many messages as the window has lines
+        return max(1, (self.height() - 4) // 2)
+
+    def matchingTags(self):
+        return [tag for tag in self.d.getAllowedTags() if self.filter in tag]
 
     def prepare(self):
         self.reset()
         self.echo("Select a tag for %s\n\n" % self.d.profile.appName, curses.A_BOLD)
 
-        for tag in self.d.getAllowedTags()[:10]:
+        tags = self.matchingTags()
+        pages = max(1, (len(tags) + self.pageSize() - 1) // self.pageSize())
+        self.page = min(self.page, pages - 1)
+        self.echo("Filter: %s_    %s tags, page %s/%s\n\n" % (self.filter, len(tags), self.page + 1, pages))
+
+        start = self.page * self.pageSize()
+        for tag in tags[start:start + self.pageSize()]:
             self.addOption(tag, "Tag %s" % tag, padding=20)
 
+        self.echo("\nType to filter, <Backspace> to erase, <PgUp>/<PgDn> to change page\n")
+
+    def handleKey(self, c):
+        if c == curses.KEY_NPAGE:
+            self.page += 1
+        elif c == curses.KEY_PPAGE:
+            self.page = max(0, self.page - 1)
+        elif c in (curses.KEY_BACKSPACE, 127, 8):
+            self.filter = self.filter[:-1]
+            self.page = 0
+        elif 32 < c < 127:
+            self.filter += chr(c)
+            self.page = 0
+        else:
+            return False
+        self.selectedOption = None
+        self.repaint()
+        return True
+
 class UI(object):
     def initDisplay(self, screen):
         curses.use_default_colors()
@@ -173,6 +344,9 @@ class UI(object):
         self.errorWindow = None
         self.windowList = collections.deque()
         curses.init_pair(1, curses.COLOR_RED, -1)
+        # Do not block on getch(), so that windows can show results computed
+        # in the background
+        self.baseWin.timeout(POLL_INTERVAL)
 
     def error(self, msg):
         ew = self.createErrorWindow()
@@ -192,12 +366,17 @@ class UI(object):
             c = self.baseWin.getch()
 
             curWin = self.windowList[0]
-            if c == 10: # enter (newline)
+            if c == -1:
+                # No key pressed within POLL_INTERVAL
+                curWin.poll()
+            elif c == 10: # enter (newline)
                 curWin.validateOption()
             elif c == curses.KEY_UP:
                 curWin.previousOption()
             elif c == curses.KEY_DOWN:
                 curWin.nextOption()
+            elif curWin.handleKey(c):
+                pass
             elif c < 256 and chr(c) in curWin.availableOptions():
                 curWin.selectOption(chr(c))
             else:
@@ -225,19 +404,7 @@ class SelectTagUI(UI):
         self.d.profile.revision = key
         raise UserCompleted()
 
-class DeploymentUI(UI):
-    def parseOptions(self):
-        opts, args = getopt.getopt(sys.argv[1:], 'vr:h', ['skip-dbversion', 'skip-minify', 'skip-notify', 'skip-restart', 'skip-host=', 'verbose', 'force-recipient=', 'no-changelog', 'help'])
-
-        for o, a in opts:
-            if o in ("-h", "--help"):
-                print >> sys.stderr, """Usage: %s [OPTIONS]
-
-    Available options:
-
-        -h | --help             This very help
-
-        -v | --verbose          Turn on verbose mode during deployment
+OPTIONS_USAGE = """        -v | --verbose          Turn on verbose mode during deployment
 
         -r | --force-recipient  Use the specified recipient for deployment notification
 
@@ -246,32 +413,192 @@ class DeploymentUI(UI):
 
         --skip-minify           Do not minify JS and CSS to speedup deployment
 
+        --minify-processes N    Minify JS and CSS with N processes (default:
+                                number of CPUs)
+
         --skip-notify           Do not send deployment notification
 
+        --notify-timeout SECS   Wait at most SECS seconds for the notification
+                                to be sent at the end of the deployment,
+                                leaving it to the next deployment otherwise
+                                (default: 10)
+
         --skip-restart          Do not restart impacted services upon deployment
 
+        --max-unavailable N     Run the after-push hooks on up to N hosts at a
+                                time, or N% of the hosts, waiting for each
+                                host to pass the health check before the next
+                                one (default: maxUnavailable of the profile)
+
         --skip-host             Do not deploy to the specified host.  Can be
                                 specified multiple times on the command-line.
 
+        --trust-state           Take the revision recorded by a recent
+                                deployment from this machine for granted
+                                instead of probing each host
+
         --no-changelog          Do not bother creating the changelog
-    """ % os.path.basename(sys.argv[0])
+
+        --changelog-max-commits N
+                                Show and ship at most the last N commits of
+                                the changelog (default: 500)
+
+        --changelog-max-bytes N Cap the changelog shipped along the tree to N
+                                bytes (default: 1048576)
+
+        --parallel N            Push to up to N hosts concurrently (default: 1)
+
+        --continue-on-error     Keep deploying to the remaining hosts when a
+                                host fails, and report failures at the end
+
+        --probe-timeout SECS    Give up fetching the deployed revision from
+                                hosts that did not answer within SECS seconds
+                                (default: 15)
+
+        --cache-dir DIR         Keep repository mirrors and other caches in
+                                DIR (default: /var/tmp/appdeploy)
+
+        --no-mirror             Clone remote repositories directly instead of
+                                going through a local mirror
+
+        --export                Extract the requested revision from the local
+                                mirror instead of checking out a full clone
+
+        --shallow               Fetch only the requested revision instead of
+                                cloning the whole repository, and only the
+                                history needed for the changelog.  Applies to
+                                repositories not cloned from the local
+                                mirror, eg with --no-mirror
+
+        --artifact-cache        Reuse the tree prepared by a previous
+                                deployment of the same revision, skipping
+                                checkout and before-push steps
+
+        --rebuild               Prepare the tree again even if it is in the
+                                artifact cache
+
+        --no-ssh-multiplexing   Open a new SSH connection for every remote
+                                command instead of sharing one per host
+
+        --timing-report FILE    Write the time spent in each deployment phase
+                                to FILE, in JSON format
+
+        --delta                 Only push the files changed since the
+                                deployed revision (rsync 3.1 or later).  The
+                                whole tree is pushed when the deployed
+                                revision is unknown or differs between hosts
+
+        --rollback              Instead of deploying, switch every host back
+                                to its previous release (profiles with
+                                releaseLayout only)
+"""
+
+SHORT_OPTIONS = 'vr:'
+LONG_OPTIONS = ['skip-dbversion', 'skip-minify', 'minify-processes=', 'skip-notify', 'notify-timeout=', 'skip-restart', 'max-unavailable=', 'skip-host=', 'verbose', 'force-recipient=', 'trust-state', 'no-changelog', 'changelog-max-commits=', 'changelog-max-bytes=', 'parallel=', 'continue-on-error', 'probe-timeout=', 'cache-dir=', 'no-mirror', 'export', 'shallow', 'artifact-cache', 'rebuild', 'no-ssh-multiplexing', 'timing-report=', 'delta', 'rollback']
+
+def applyOptions(options, opts):
+    """Apply the deployment options parsed by getopt with SHORT_OPTIONS and
+    LONG_OPTIONS to a DeploymentOptions instance, ignoring other options"""
+    for o, a in opts:
+        if o in ("-v", "--verbose"):
+            options.verbose = 1
+        if o in ("--skip-minify",):
+            options.doMinify = 0
+        if o in ("--minify-processes",):
+            try:
+                options.minifyProcesses = max(1, int(a))
+            except ValueError:
+                raise getopt.GetoptError("--minify-processes expects a number of processes, got %s" % a)
+        if o in ("--skip-notify",):
+            options.doNotify = 0
+        if o in ("--notify-timeout",):
+            try:
+                options.notifyTimeout = float(a)
+            except ValueError:
+                raise getopt.GetoptError("--notify-timeout expects a number of seconds, got %s" % a)
+        if o in ("--skip-host",):
+            options.skippedHosts.append(a)
+        if o in ("--skip-dbversion",):
+            options.skipDbVersionCheck = True
+        if o in ("--skip-restart",):
+            options.skipRestart = True
+        if o in ("--max-unavailable",):
+            try:
+                if a.endswith("%"):
+                    float(a[:-1])
+                    options.maxUnavailable = a
+                else:
+                    options.maxUnavailable = max(1, int(a))
+            except ValueError:
+                raise getopt.GetoptError("--max-unavailable expects a number or a percentage of hosts, got %s" % a)
+        if o in ("-r", "--force-recipient"):
+            options.forceRecipient = a
+        if o in ("--trust-state",):
+            options.trustState = True
+        if o in ("--no-changelog",):
+            options.doWriteChangeLog = False
+        if o in ("--changelog-max-commits",):
+            try:
+                options.changeLogMaxCommits = max(1, int(a))
+            except ValueError:
+                raise getopt.GetoptError("--changelog-max-commits expects a number of commits, got %s" % a)
+        if o in ("--changelog-max-bytes",):
+            try:
+                options.changeLogMaxBytes = max(0, int(a))
+            except ValueError:
+                raise getopt.GetoptError("--changelog-max-bytes expects a number of bytes, got %s" % a)
+        if o in ("--parallel",):
+            try:
+                options.parallel = max(1, int(a))
+            except ValueError:
+                raise getopt.GetoptError("--parallel expects a number of hosts, got %s" % a)
+        if o in ("--continue-on-error",):
+            options.failFast = False
+        if o in ("--probe-timeout",):
+            try:
+                options.probeTimeout = float(a)
+            except ValueError:
+                raise getopt.GetoptError("--probe-timeout expects a number of seconds, got %s" % a)
+        if o in ("--cache-dir",):
+            options.cacheDir = a
+        if o in ("--no-mirror",):
+            options.useMirror = False
+        if o in ("--export",):
+            options.exportTree = True
+        if o in ("--shallow",):
+            options.shallowClone = True
+        if o in ("--artifact-cache",):
+            options.useArtifactCache = True
+        if o in ("--rebuild",):
+            options.forceRebuild = True
+        if o in ("--no-ssh-multiplexing",):
+            options.sshMultiplexing = False
+        if o in ("--timing-report",):
+            options.timingReport = a
+        if o in ("--delta",):
+            options.deltaPush = True
+        if o in ("--rollback",):
+            options.rollback = True
+
+# Seconds a profile must stay highlighted before prefetching its deployment
+PREFETCH_DELAY = 0.5
+
+class DeploymentUI(UI):
+    def parseOptions(self):
+        opts, args = getopt.getopt(sys.argv[1:], SHORT_OPTIONS + 'h', LONG_OPTIONS + ['help'])
+
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                print >> sys.stderr, """Usage: %s [OPTIONS]
+
+    Available options:
+
+        -h | --help             This very help
+
+%s""" % (os.path.basename(sys.argv[0]), OPTIONS_USAGE)
                 sys.exit(0)
-            if o in ("-v", "--verbose"):
-                self.options.verbose = 1
-            if o in ("--skip-minify"):
-                self.options.doMinify = 0
-            if o in ("--skip-notify"):
-                self.options.doNotify = 0
-            if o in ("--skip-host"):
-                self.options.skippedHosts.append(a)
-            if o in ("--skip-dbversion"):
-                self.options.skipDbVersionCheck = True
-            if o in ("--skip-restart"):
-                self.options.skipRestart = True
-            if o in ("-r", "--force-recipient"):
-                self.options.forceRecipient = a
-            if o in ("--no-changelog"):
-                self.options.doWriteChangeLog = False
+
+        applyOptions(self.options, opts)
 
     def __init__(self, applications):
         self.applications = applications
@@ -280,6 +607,10 @@ class DeploymentUI(UI):
             self.applicationsAsDict[applicationKey] = applicationInfo
         self.options = appdeploy.DeploymentOptions()
         self.parseOptions()
+        # Deployment of the highlighted profile, prefetching in the background
+        self.speculative = None
+        self.speculativeKey = None
+        self.prefetchTimer = None
 
     def display(self, screen):
         UI.initDisplay(self, screen)
@@ -299,21 +630,63 @@ class DeploymentUI(UI):
         displayName = self.selectedApplication['displayName']
         profiles = self.selectedApplication['profiles']
         if key == 'q':
+            self.cancelSpeculation()
             self.windowList.popleft()
             self.refresh()
         elif key in [p[0] for p in profiles]:
-            for profile in profiles:
-                if profile[0] == key:
-                    selectedProfile = profile[1]
-                    break
-            self.deployment = appdeploy.getDeployment(selectedProfile, self.options)
+            if self.speculativeKey == key:
+                # Reuse the probes and mirror update started while the profile
+                # was highlighted
+                self.stopPrefetchTimer()
+                self.deployment = self.speculative
+            else:
+                self.cancelSpeculation()
+                self.deployment = appdeploy.getDeployment(self.getProfile(key), self.options)
             raise UserCompleted()
         else:
             self.error("No action defined for option: %s" % key)
 
+    def getProfile(self, key):
+        for profile in self.selectedApplication['profiles']:
+            if profile[0] == key:
+                return profile[1]
+        return None
+
+    def stopPrefetchTimer(self):
+        if self.prefetchTimer is not None:
+            self.prefetchTimer.cancel()
+            # The prefetch may have been starting right now
+            self.prefetchTimer.join()
+            self.prefetchTimer = None
+
+    def cancelSpeculation(self):
+        self.stopPrefetchTimer()
+        if self.speculative is not None:
+            self.speculative.cancelPrefetch()
+        self.speculative = None
+        self.speculativeKey = None
+
+    def prefetchProfile(self, key):
+        """Start preparing the deployment of the highlighted profile in the
+        background, in case the operator picks it"""
+        if key == self.speculativeKey:
+            return
+        self.cancelSpeculation()
+        profile = self.getProfile(key)
+        if profile is None or self.options.rollback:
+            return
+        self.speculative = appdeploy.getDeployment(profile, self.options)
+        self.speculativeKey = key
+        # Wait a little so that scrolling through the profiles does not probe
+        # every one of them
+        self.prefetchTimer = threading.Timer(PREFETCH_DELAY, self.speculative.prefetch)
+        self.prefetchTimer.daemon = True
+        self.prefetchTimer.start()
+
     def showProfiles(self, application):
-        w = SelectProfileScreen(self.baseWin, application)
+        w = SelectProfileScreen(self.baseWin, application, appdeploy.getStateStore(self.options))
         w.handler = self.selectProfile
+        w.highlightHandler = self.prefetchProfile
         w.repaint()
         self.windowList.appendleft(w)
 
@@ -346,25 +719,36 @@ def main(applications):
 
     d = ui.deployment
 
-    # Prepare deployment
-    d.prepare()
-    if d.profile.selectTag:
-        if len(d.getAllowedTags()) == 0:
-            raise appdeploy.DeploymentFailed("Cannot find any tag matching %s.*" % d.profile.branch)
-        # Make sure user has seen deployment prepare output()
-        print
-        raw_input("Press <Enter> to continue ")
-        # Run a new ncurses app to select a tag
-        ui = SelectTagUI(d)
-
-        try:
-            curses.wrapper(ui.display)
-        except UserCompleted:
-            pass
+    try:
+        if d.options.rollback:
+            action = d.rollback
+        else:
+            action = d.run
+            # Prepare deployment
+            d.prepare()
+
+        if d.profile.selectTag and not(d.options.rollback):
+            if len(d.getAllowedTags()) == 0:
+                raise appdeploy.DeploymentFailed("Cannot find any tag matching %s.*" % (d.profile.branch or ""))
+            # Make sure user has seen deployment prepare output()
+            print
+            raw_input("Press <Enter> to continue ")
+            # Run a new ncurses app to select a tag
+            ui = SelectTagUI(d)
+
+            try:
+                curses.wrapper(ui.display)
+            except UserCompleted:
+                pass
+    except:
+        # run() closes the master connections opened by the probe, but it
+        # will not run
+        d.connections.close()
+        raise
 
     try:
         # Run the deployment
-        d.run()
+        action()
         print
         print "DEPLOYMENT SUCCESSFUL"
     except SystemExit:
@@ -380,6 +764,7 @@ def main(applications):
         for line in traceback.format_exc().split("\n"):
             syslog.syslog(syslog.LOG_ERR, line)
     finally:
+        syslog.syslog(syslog.LOG_INFO, "Deployment of %s to profile %s timings: %s" % (d.profile.appName, d.profile.name, d.timer.formatSummaryLine()))
         if not(d.success) and not(d.cancelled):
             print
             print "DEPLOYMENT FAILED"
@@ -387,5 +772,150 @@ def main(applications):
             syslog.syslog(syslog.LOG_ERR, "Deployment of %s to profile %s initiated by %s failed" % (d.profile.appName, d.profile.name, os.environ['LOGNAME']))
             sys.exit(1)
 
+HEADLESS_USAGE = """        -a | --application KEY  Deploy the application with the given key
+
+        -p | --profile KEY      Deploy using the profile with the given key
+
+        --revision REV          Deploy this revision instead of the one of
+                                the profile (required for profiles that
+                                select a tag)
+
+        --confirm POLICY        How to answer confirmations: always,
+                                new-revision (refuse to deploy the revision
+                                already deployed) or never (stop before
+                                pushing).  Default: new-revision
+
+        --json                  Print the outcome as a JSON object on stdout,
+                                the deployment output goes to stderr
+"""
+
+# Exit status of headlessMain()
+EXIT_SUCCESS = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NOT_CONFIRMED = 3
+
+def headlessMain(applications):
+    """Non-interactive counterpart of main(): the application, profile and
+    revision are given on the command-line, confirmations are answered by a
+    policy, and neither curses nor the pager are used.  The outcome is
+    reported through the exit status, and optionally as JSON."""
+    syslog.openlog("deploy", syslog.LOG_PID, syslog.LOG_USER)
+    options = appdeploy.DeploymentOptions()
+    options.interactive = False
+    applicationKey = profileKey = revision = None
+    asJson = False
+
+    def usageError(message):
+        print >> sys.stderr, "ERROR: %s" % message
+        print >> sys.stderr, "Try %s --help" % os.path.basename(sys.argv[0])
+        sys.exit(EXIT_USAGE)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], SHORT_OPTIONS + 'ha:p:', LONG_OPTIONS + ['help', 'application=', 'profile=', 'revision=', 'confirm=', 'json'])
+        applyOptions(options, opts)
+    except getopt.GetoptError, e:
+        usageError(e)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print >> sys.stderr, """Usage: %s --application KEY --profile KEY [OPTIONS]
+
+    Available options:
+
+        -h | --help             This very help
+
+%s
+%s
+    Exit status: %s on success, %s if the deployment failed, %s on usage
+    errors, %s if the deployment was not confirmed by the policy""" % (os.path.basename(sys.argv[0]), HEADLESS_USAGE, OPTIONS_USAGE, EXIT_SUCCESS, EXIT_FAILED, EXIT_USAGE, EXIT_NOT_CONFIRMED)
+            sys.exit(EXIT_SUCCESS)
+        if o in ("-a", "--application"):
+            applicationKey = a
+        if o in ("-p", "--profile"):
+            profileKey = a
+        if o in ("--revision",):
+            revision = a
+        if o in ("--confirm",):
+            if a not in appdeploy.CONFIRM_POLICIES:
+                usageError("--confirm expects one of %s" % ", ".join(appdeploy.CONFIRM_POLICIES))
+            options.confirmPolicy = a
+        if o in ("--json",):
+            asJson = True
+
+    applicationsAsDict = dict(applications)
+    if applicationKey not in applicationsAsDict:
+        usageError("Please choose an application with --application among: %s" % ", ".join([k for (k, v) in applications]))
+    profiles = dict(applicationsAsDict[applicationKey]['profiles'])
+    if profileKey not in profiles:
+        usageError("Please choose a profile with --profile among: %s" % ", ".join([k for (k, v) in applicationsAsDict[applicationKey]['profiles']]))
+    profile = profiles[profileKey]
+
+    if revision is not None:
+        profile.revision = revision
+    elif profile.selectTag and not(options.rollback):
+        usageError("Profile %s selects a tag interactively, please provide --revision" % profile.name)
+
+    out = sys.stdout
+    if asJson:
+        # Keep stdout for the JSON outcome
+        sys.stdout = sys.stderr
+
+    d = appdeploy.getDeployment(profile, options)
+    status = EXIT_FAILED
+    error = None
+    try:
+        if options.rollback:
+            d.rollback()
+        else:
+            try:
+                d.prepare()
+            except:
+                # Closed by run() otherwise
+                d.connections.close()
+                raise
+            d.run()
+        print
+        print "DEPLOYMENT SUCCESSFUL"
+        status = EXIT_SUCCESS
+    except SystemExit:
+        if not(d.cancelled):
+            raise
+        status = EXIT_NOT_CONFIRMED
+    except appdeploy.DeploymentFailed, e:
+        error = str(e)
+        print
+        print "ERROR: %s" % e
+        for line in error.split("\n"):
+            syslog.syslog(syslog.LOG_ERR, line)
+    except:
+        error = traceback.format_exc()
+        traceback.print_exc()
+        for line in error.split("\n"):
+            syslog.syslog(syslog.LOG_ERR, line)
+
+    syslog.syslog(syslog.LOG_INFO, "Deployment of %s to profile %s timings: %s" % (d.profile.appName, d.profile.name, d.timer.formatSummaryLine()))
+    if status == EXIT_FAILED:
+        print
+        print "DEPLOYMENT FAILED"
+        syslog.syslog(syslog.LOG_ERR, "Deployment of %s to profile %s initiated by %s failed" % (d.profile.appName, d.profile.name, os.environ.get('LOGNAME')))
+
+    if asJson:
+        sys.stdout = out
+        print json.dumps({
+            'status': {EXIT_SUCCESS: "success", EXIT_FAILED: "failed", EXIT_NOT_CONFIRMED: "not-confirmed"}[status],
+            'application': applicationKey,
+            'profile': profileKey,
+            'oldRevision': getattr(d, 'oldRevision', None),
+            'newRevision': getattr(d, 'newRevision', None),
+            'deployedRevisions': getattr(d, 'deployedRevisions', None),
+            'hosts': list(d.getHosts()),
+            'deployedHosts': d.deployedHosts,
+            'error': error,
+            'timings': d.timer.asdict(),
+        }, sort_keys=True)
+
+    sys.exit(status)
+
 if __name__ == "__main__":
     main()